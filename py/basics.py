@@ -1,42 +1,34 @@
 
-import comp
 import cons
-import cons_util
-import debug
 import function
-import parse
-import source
+import printer
 
 import code
 import operator as op
 import sys
 
 def define_basics(env):
-    def display(c):
-        if isinstance(c, cons.String):
-            sys.stdout.write(c.string)
-        else:
-            sys.stdout.write(c.sexpr())
-
     def call_void(func, *args):
         func(*args)
-        return cons.Void()
+        return cons.VOID
 
-    def define_py(name, func, pure=True):
+    # Pure builtins may be folded, memoised and called from frameless
+    # functions, so purity is opted into
+    def define_py(name, func, pure=False):
         env.glob_const[name] = function.Generic(name, func, pure)
 
     def define_py_pred(name, func):
         env.glob_const[name] = function.Generic(name, lambda *a: cons.from_py(func(*a)), pure=True)
 
-    define_py     ('car', lambda x: x.car)
-    define_py     ('cdr', lambda x: x.cdr)
-    define_py     ('cons', lambda x, y: cons.Pair(x, y))
-    define_py     ('display', lambda x: call_void(display, x), pure=False)
+    define_py     ('car', lambda x: x.car, pure=True)
+    define_py     ('cdr', lambda x: x.cdr, pure=True)
+    define_py     ('cons', lambda x, y: cons.Pair(x, y), pure=True)
+    define_py     ('display', lambda x: call_void(printer.display, sys.stdout, x))
     define_py_pred('eq?', lambda x, y: x is y)
     define_py_pred('equal?', lambda x, y: x.equal(y))
-    define_py     ('list', lambda *args: cons.from_py(args))
-    define_py     ('newline', lambda: cons.String('\n'))
-    define_py     ('not', lambda x: cons.from_py(cons.is_false(x)))
+    define_py     ('list', lambda *args: cons.from_py(args), pure=True)
+    define_py     ('newline', lambda: cons.String('\n'), pure=True)
+    define_py     ('not', lambda x: cons.from_py(cons.is_false(x)), pure=True)
     define_py_pred('null?', lambda x: isinstance(x, cons.Null))
     define_py_pred('pair?', lambda x: isinstance(x, cons.Pair))
     define_py_pred('number?', lambda x: isinstance(x, cons.Number))
@@ -44,6 +36,17 @@ def define_basics(env):
     define_py_pred('string?', lambda x: isinstance(x, cons.String))
     define_py_pred('symbol?', lambda x: isinstance(x, cons.Symbol))
 
+    define_py     ('make-vector', lambda n, fill=cons.VOID: cons.Vector([fill] * n.number), pure=True)
+    define_py     ('vector', lambda *args: cons.Vector(list(args)), pure=True)
+    define_py     ('vector-length', lambda v: cons.Number(len(v.items)), pure=True)
+    define_py     ('vector-ref', lambda v, k: v.ref(k), pure=True)
+    define_py     ('vector-set!', lambda v, k, x: v.set(k, x))
+    define_py_pred('vector?', lambda x: isinstance(x, cons.Vector))
+    define_py     ('make-hash-table', lambda kind=cons.Symbol('equal'): cons.HashTable(eqv=kind is cons.Symbol('eqv')), pure=True)
+    define_py     ('hash-ref', lambda t, k, default=None: t.ref(k, default), pure=True)
+    define_py     ('hash-set!', lambda t, k, x: t.set(k, x))
+    define_py_pred('hash-table?', lambda x: isinstance(x, cons.HashTable))
+
     env.glob_const['apply'] = function.Apply()
 
     env.glob_const['+'] = function.PyOp(op.add)
@@ -55,43 +58,39 @@ def define_basics(env):
     env.glob_const['>'] = function.PyOp(op.gt)
     env.glob_const['>='] = function.PyOp(op.ge)
 
+    if cons.numpy is not None:
+        define_arrays(env)
+
+def define_arrays(env):
+    "Numeric arrays, see cons.Array. Arithmetic builtins broadcast over them"
+    np = cons.numpy
+
+    def define_py(name, func):
+        env.glob_const[name] = function.Generic(name, func, True)
+
+    def numbers(p):
+        while isinstance(p, cons.Pair):
+            yield p.car.number
+            p = p.cdr
+
+    def array(values):
+        return cons.Array(np.array(values))
+
+    define_py('array', lambda *args: array([x.number for x in args]))
+    define_py('list->array', lambda l: array(list(numbers(l))))
+    define_py('vector->array', lambda v: array([x.number for x in v.items]))
+    define_py('array->list', lambda a: cons.from_py(a.array.tolist()))
+    define_py('array->vector', lambda a: cons.Vector([cons.Number(x) for x in a.array.tolist()]))
+    define_py('array-length', lambda a: cons.Number(len(a.array)))
+    define_py('array-ref', lambda a, k: cons.from_py(a.array[k.number]))
+    # A view sharing the elements of a
+    define_py('array-slice', lambda a, start, end: cons.Array(a.array[start.number:end.number]))
+    define_py('array?', lambda x: cons.from_py(isinstance(x, cons.Array)))
+    define_py('array-sum', lambda a: cons.from_py(a.array.sum()))
+    define_py('array-dot', lambda a, b: cons.from_py(np.dot(a.array, b.array)))
+    define_py('array-mean', lambda a: cons.from_py(a.array.mean()))
+
 def define_loops(env):
     'define things like map and for-each'
-    dbg = debug.stream_tree()
-
-    def eval_fn(source):
-        return env.eval(comp.compile_expr(parse.parse_one(source), env))
-
-    primitive_builtins = [x for x in cons_util.traverse_list(
-        eval_fn(source.String('loops.basics',
-"""((lambda ()
-  (define (all-car l)
-    (if (null? l)
-        ()
-        (cons (car (car l)) (all-car (cdr l)))))
-  (define (all-cdr l)
-    (if (null? l)
-        ()
-        (cons (cdr (car l)) (all-cdr (cdr l)))))
-  (define (all-null? l)
-    (if (null? l)
-        true
-        (if (null? (car l))
-            (all-null? (cdr l))
-            false)))
-  (define (map fn lsts)
-    (if (all-null? lsts)
-        ()
-        (cons (apply fn (all-car lsts)) (map fn (all-cdr lsts)))))
-  (define (for-each fn lsts)
-    (if (not (all-null? lsts))
-        (begin
-          (apply fn (all-car lsts))
-          (for-each fn (all-cdr lsts)))))
-  (list
-    (lambda (fn . lsts) (map fn lsts))
-    (lambda (fn . lsts) (for-each fn lsts)))))
-        """)))]
-
-    env.glob_const['map'] = primitive_builtins[0]
-    env.glob_const['for-each'] = primitive_builtins[1]
+    env.glob_const['map'] = function.Map()
+    env.glob_const['for-each'] = function.ForEach()
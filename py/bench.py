@@ -0,0 +1,659 @@
+#! /usr/bin/env python3
+
+import basics
+import cache
+import comp
+import cons
+import debug
+import eval
+import function
+import instr
+import parse
+import printer
+import source
+
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+def new_env(with_loops=False):
+    env = eval.Env(debug.stream_tree())
+    basics.define_basics(env)
+    if with_loops:
+        basics.define_loops(env)
+    return env
+
+def compile_src(env, name, src):
+    return comp.compile_module(iter(source.String(name, src)), env, debuggable=True)
+
+def timed(func, repeat=3):
+    best = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, seconds, **extra):
+    items = ['%-28s %9.4f s' % (name, seconds)]
+    for key in sorted(extra):
+        items.append('%s=%s' % (key, extra[key]))
+    print('  '.join(items))
+
+fib_src = """
+(define (fib n)
+  (if (< n 2)
+      n
+      (+ (fib (- n 1)) (fib (- n 2)))))
+(fib 18)
+"""
+
+closure_src = """
+(define (make-adder x) (lambda (y) (+ x y)))
+(define (run add n acc)
+  (if (> n 0)
+      (run add (- n 1) (add acc))
+      acc))
+(run (make-adder 1) 20000 0)
+"""
+
+def bench_dispatch():
+    'Time per executed instruction on call-heavy code'
+    for name, src in [('fib', fib_src), ('closure', closure_src)]:
+        env = new_env()
+        ins = compile_src(env, name, src)
+
+        counter = debug.InsCounter()
+        env.dbg.eval = counter
+        env.eval_noexcept(ins)
+        env.dbg.eval = debug.stream_tree().eval
+
+        seconds = timed(lambda: env.eval_noexcept(ins))
+        report('dispatch.' + name, seconds,
+               instructions=counter.count,
+               ns_per_ins='%.1f' % (seconds * 1e9 / counter.count))
+
+nest_src = """
+(define (nest a)
+  (lambda (b)
+    (lambda (c)
+      (lambda (d)
+        (lambda (e)
+          (lambda (f)
+            (lambda (g)
+              (lambda () (+ a b c d e f g)))))))))
+(define deep (((((((nest 1) 2) 3) 4) 5) 6) 7))
+(define (run fn n acc)
+  (if (> n 0)
+      (run fn (- n 1) (+ acc (fn)))
+      acc))
+(run deep 5000 0)
+"""
+
+globals_src = """
+(define (sum-steps n acc) (if (< n 1) acc (sum-steps (- n 1) (add-step acc))))
+(define (add-step x) (+ x step))
+(define step 1)
+(define counter 0)
+(define (bump n) (if (< n 1) counter (begin (set! counter (+ counter step)) (bump (- n 1)))))
+(define (touch n)
+  (if (< n 1)
+      counter
+      (begin
+        step step step step step step step step
+        (set! counter step) (set! counter step) (set! counter step) (set! counter step)
+        (touch (- n 1)))))
+"""
+
+def bench_globals():
+    'Loads and stores of globals defined after the functions using them'
+    env = new_env()
+    for ins in comp.compile_iterator(iter(source.String('globals', globals_src)), env):
+        env.eval_noexcept(ins)
+    n = 100000
+    for name, src in [('load', '(sum-steps %d 0)' % n), ('store', '(bump %d)' % n),
+                      ('touch_12', '(touch %d)' % n)]:
+        ins = comp.compile_expr(parse.parse_one(source.String('globals', src)), env)
+        report('globals.' + name, timed(lambda: env.eval_noexcept(ins)), iterations=n)
+
+def bench_locals():
+    'Variable access through deeply nested closures'
+    env = new_env()
+    ins = compile_src(env, 'nest', nest_src)
+    report('locals.nest', timed(lambda: env.eval_noexcept(ins)))
+
+    local = function.Locals(1, None)
+    for n in range(16):
+        local = function.Locals(1, local)
+    def lookups():
+        for n in range(100000):
+            local.lookup(0, 16)
+            local.skip(16)
+    report('locals.lookup_depth16', timed(lookups), calls=200000)
+
+# The interpreted map/for-each that basics.define_loops used to install
+scheme_loops_src = """((lambda ()
+  (define (all-car l)
+    (if (null? l)
+        ()
+        (cons (car (car l)) (all-car (cdr l)))))
+  (define (all-cdr l)
+    (if (null? l)
+        ()
+        (cons (cdr (car l)) (all-cdr (cdr l)))))
+  (define (all-null? l)
+    (if (null? l)
+        true
+        (if (null? (car l))
+            (all-null? (cdr l))
+            false)))
+  (define (map fn lsts)
+    (if (all-null? lsts)
+        ()
+        (cons (apply fn (all-car lsts)) (map fn (all-cdr lsts)))))
+  (define (for-each fn lsts)
+    (if (not (all-null? lsts))
+        (begin
+          (apply fn (all-car lsts))
+          (for-each fn (all-cdr lsts)))))
+  (list
+    (lambda (fn . lsts) (map fn lsts))
+    (lambda (fn . lsts) (for-each fn lsts)))))
+"""
+
+loops_src = """
+(define (iota n acc)
+  (if (> n 0) (iota (- n 1) (cons n acc)) acc))
+(define l (iota 2000 ()))
+(map + l l)
+(map (lambda (x) (* x x)) l)
+(for-each (lambda (x y) x) l l)
+"""
+
+def bench_loops():
+    'Native map/for-each against the old interpreted versions'
+    env = new_env(with_loops=True)
+    ins = compile_src(env, 'loops', loops_src)
+    native = timed(lambda: env.eval_noexcept(ins))
+
+    env = new_env()
+    builtins = env.eval_noexcept(comp.compile_expr(
+        parse.parse_one(source.String('scheme_loops', scheme_loops_src)), env))
+    env.glob_const['map'] = builtins.car
+    env.glob_const['for-each'] = builtins.cdr.car
+    ins = compile_src(env, 'loops', loops_src)
+    interpreted = timed(lambda: env.eval_noexcept(ins))
+
+    report('loops.interpreted', interpreted)
+    report('loops.native', native, speedup='%.1fx' % (interpreted / native))
+
+def generated_data(forms=20000):
+    line = '(define (f-%d x) (list "str\\n" 1.5 -3 \'sym (g x y) (a . b))) ; comment\n'
+    return ''.join([line % n for n in range(forms)])
+
+def parse_all(i):
+    n = 0
+    while True:
+        try:
+            parse.parse_iterator(i)
+            n += 1
+        except parse.NoValueError:
+            return n
+
+def parse_all_values(i):
+    values = []
+    while True:
+        try:
+            values.append(parse.parse_iterator(i))
+        except parse.NoValueError:
+            return values
+
+def bench_parse():
+    'Parser throughput on generated data'
+    text = generated_data()
+    mb = len(text) / 1e6
+
+    seconds = timed(lambda: parse_all(iter(source.String('data', text))))
+    report('parse.tokens', seconds, MB_per_s='%.2f' % (mb / seconds))
+
+    depth = 100000
+    deep = '(' * depth + 'a' + ')' * depth
+    try:
+        seconds = timed(lambda: parse_all(iter(source.String('deep', deep))))
+        report('parse.deep', seconds, depth=depth)
+    except RecursionError:
+        print('parse.deep: RecursionError')
+
+    # Lower bound for the old parser, which read every character through CharIterator
+    def read_chars():
+        for ch in iter(source.String('data', text)):
+            pass
+    seconds = timed(read_chars)
+    report('parse.char_iteration_only', seconds, MB_per_s='%.2f' % (mb / seconds))
+
+def retained(build):
+    'Bytes still allocated after build() returns, while its result is alive'
+    tracemalloc.start()
+    result = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current
+
+def bench_memory():
+    'Bytes per cons cell, instruction and Locals'
+    n = 1000000
+    def pairs():
+        p = cons.NULL
+        for k in range(n):
+            p = cons.Pair(p, p)
+        return p
+    report('memory.pair', timed(pairs, repeat=1), bytes_per_cell='%.1f' % (retained(pairs) / n))
+
+    text = '(' + ' '.join(['%d' % k for k in range(n // 10)]) + ')'
+    def parsed():
+        return parse.parse_one(source.String('data', text))
+    report('memory.parsed_cell', timed(parsed, repeat=1),
+           bytes_per_cell_with_number_and_tag='%.1f' % (retained(parsed) / (n // 10)))
+
+    def instructions():
+        return [(instr.LoadLocal(k), instr.Arg(), instr.LoadSkip(k, 1), instr.Call(2)) for k in range(n // 4)]
+    report('memory.instruction', timed(instructions, repeat=1),
+           bytes_per_ins='%.1f' % ((retained(instructions) - retained(lambda: [(1, 2, 3, 4) for k in range(n // 4)])) / n))
+
+    def locals():
+        return [function.Locals(2, None) for k in range(n // 10)]
+    report('memory.locals', timed(locals, repeat=1), bytes_per_locals='%.1f' % (retained(locals) / (n // 10)))
+
+def bench_print():
+    'Writing a 10^6 element list and a 10^5 deep list'
+    n = 1000000
+    flat = cons.from_py(list(range(n)))
+    seconds = timed(lambda: printer.write(io.StringIO(), flat), repeat=1)
+    report('print.flat_write', seconds, elements=n)
+    report('print.flat_sexpr', timed(lambda: flat.sexpr(), repeat=1), elements=n)
+
+    deep = cons.NULL
+    for k in range(n // 10):
+        deep = cons.Pair(deep, cons.NULL)
+    try:
+        report('print.deep_sexpr', timed(lambda: deep.sexpr(), repeat=1), depth=n // 10)
+    except RecursionError:
+        print('print.deep_sexpr: RecursionError')
+
+def script_data(forms):
+    lines = []
+    for n in range(forms):
+        if n % 1000 == 0:
+            lines.append('(define (g%d x) (+ x %d))' % (n, n))
+        else:
+            lines.append('(car (cdr (list %d "s" \'sym (g%d %d))))' % (n, n - n % 1000, n))
+    return '\n'.join(lines)
+
+def bench_stream():
+    'Running a 100k-form script file form by form'
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, 'script.spr')
+
+        def stream():
+            env = new_env()
+            for ins in comp.compile_iterator(iter(source.File(fn)), env):
+                env.eval_noexcept(ins)
+
+        def per_form():
+            # A new parser and compiler chain for every form
+            env = new_env()
+            i = iter(source.File(fn))
+            while True:
+                try:
+                    expr = parse.parse_iterator(i)
+                except parse.NoValueError:
+                    break
+                env.eval_noexcept(comp.compile_expr(expr, env))
+
+        def module():
+            env = new_env()
+            env.eval_noexcept(comp.compile_module(iter(source.File(fn)), env))
+
+        def cached():
+            env = new_env()
+            for ins in cache.compile_file(fn, env):
+                env.eval_noexcept(ins)
+
+        forms = 100000
+        with open(fn, 'w') as f:
+            f.write(script_data(forms))
+        report('stream.compile_iterator', timed(stream, repeat=1), forms=forms)
+        report('stream.per_form', timed(per_form, repeat=1), forms=forms)
+        report('stream.compile_module', timed(module, repeat=1), forms=forms)
+        cached()
+        report('stream.cache_warm', timed(cached, repeat=1), forms=forms)
+
+        # Peak memory should not grow with the length of the file
+        for forms in [5000, 20000]:
+            with open(fn, 'w') as f:
+                f.write(script_data(forms))
+            for name, func in [('compile_iterator', stream), ('compile_module', module)]:
+                tracemalloc.start()
+                func()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                print('stream.peak.%-16s forms=%-6d peak_bytes=%d' % (name, forms, peak))
+
+def bench_mmap():
+    'Memory held while parsing File and MappedFile sources of growing size'
+    with tempfile.TemporaryDirectory() as d:
+        for forms in [5000, 20000]:
+            fn = os.path.join(d, 'data.spr')
+            with open(fn, 'w') as f:
+                f.write(generated_data(forms))
+            size = os.path.getsize(fn)
+            for name, src in [('file', source.File(fn)), ('mapped', source.MappedFile(fn))]:
+                for keep in [False, True]:
+                    tracemalloc.start()
+                    i = iter(src)
+                    values = []
+                    while True:
+                        try:
+                            value = parse.parse_iterator(i)
+                        except parse.NoValueError:
+                            break
+                        if keep:
+                            values.append(value)
+                    current, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    i.close()
+                    print('mmap.%-6s %7d bytes  %s  bytes/file byte=%.2f' % (
+                        name, size, 'kept values  ' if keep else 'streaming peak',
+                        (current if keep else peak) / size))
+
+pred_src = """
+(define (iota n acc)
+  (if (> n 0) (iota (- n 1) (cons n acc)) acc))
+(define l (iota 20000 ()))
+(map (lambda (x) (list (< x 10000) (null? x) '())) l)
+"""
+
+def bench_alloc():
+    'Memory held by predicate results, and by parsed data'
+    env = new_env(with_loops=True)
+    ins = compile_src(env, 'pred', pred_src)
+    tracemalloc.start()
+    result = env.eval_noexcept(ins)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    report('alloc.predicates', timed(lambda: env.eval_noexcept(ins)), kept_bytes=current)
+
+    text = generated_data(5000)
+    tracemalloc.start()
+    values = parse_all_values(iter(source.String('data', text)))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    report('alloc.parse', timed(lambda: parse_all(iter(source.String('data', text)))),
+           kept_bytes=current)
+
+def bench_cache():
+    'Compiling a generated library with a cold and a warm compile cache'
+    # Module code only keeps reachable functions, so reference them all
+    lines = []
+    for n in range(2000):
+        lines.append('(define (f%d x y) (if (< x y) (list x "%d" \'s%d) (f%d y x)))' % (n, n, n, n))
+    lines.append('(list %s)' % ' '.join(['(f%d 2 1)' % n for n in range(2000)]))
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, 'lib.spr')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(lines))
+
+        def startup():
+            env = new_env()
+            for ins in cache.compile_file(fn, env):
+                pass
+
+        def cold():
+            shutil.rmtree(os.path.join(d, cache.CACHE_DIR), ignore_errors=True)
+            startup()
+
+        cold_seconds = timed(cold)
+        warm_seconds = timed(startup)
+        report('cache.cold', cold_seconds)
+        report('cache.warm', warm_seconds, speedup='%.1fx' % (cold_seconds / warm_seconds))
+
+def recursive_equal(a, b):
+    'The old Pair.equal'
+    if a.__class__ is cons.Pair:
+        return b.__class__ is cons.Pair and recursive_equal(a.car, b.car) and recursive_equal(a.cdr, b.cdr)
+    return a.equal(b)
+
+def bench_equal():
+    'equal? on long lists: copies, shared tails and cached hashes'
+    # The old equal? recurses on cdr, so keep within the recursion limit
+    short = [[n, cons.String(str(n))] for n in range(300)]
+    a = cons.from_py(short)
+    b = cons.from_py(short)
+    old = timed(lambda: [recursive_equal(a, b) for n in range(100)])
+    new = timed(lambda: [cons.equal(a, b) for n in range(100)])
+    report('equal.recursive', old)
+    report('equal.iterative', new, speedup='%.1fx' % (old / new))
+
+    items = list(range(200000))
+    a = cons.from_py(items)
+    b = cons.from_py(items)
+    report('equal.copies', timed(lambda: cons.equal(a, b)), length=len(items))
+    shared = cons.Pair(cons.Number(0), a.cdr)
+    report('equal.shared_tail', timed(lambda: cons.equal(a, shared)), length=len(items))
+    c = cons.from_py(items[:-1] + [-1])
+    report('equal.first_hash', timed(lambda: cons.structural_hash(c), repeat=1), length=len(items))
+    cons.structural_hash(a)
+    report('equal.hash_mismatch', timed(lambda: cons.equal(a, c)), length=len(items))
+
+numeric_src = """
+(define (sum-list l acc)
+  (if (null? l) acc (sum-list (cdr l) (+ acc (* 2 (car l))))))
+(sum-list readings 0)
+"""
+
+def bench_numeric():
+    'Scaling and summing numbers one at a time, and as a NumPy array'
+    if cons.numpy is None:
+        print('numeric: numpy is not installed')
+        return
+    n = 100000
+    env = new_env()
+    env.glob_const['readings'] = cons.from_py(list(range(n)))
+    ins = compile_src(env, 'numeric', numeric_src)
+    boxed = timed(lambda: env.eval_noexcept(ins))
+
+    env = new_env()
+    env.glob_const['readings'] = cons.Array(cons.numpy.arange(n))
+    ins = compile_src(env, 'numeric', '(array-sum (* 2 readings))')
+    array = timed(lambda: env.eval_noexcept(ins))
+    report('numeric.boxed', boxed, elements=n)
+    report('numeric.array', array, elements=n, speedup='%.0fx' % (boxed / array))
+
+frames_src = """
+(define (third a b c) c)
+(define (calls n) (if (< n 1) n (calls (third n n (third n n (- n 1))))))
+(define (count n) (if (< n 1) 0 (+ 1 (count (- n 1)))))
+"""
+
+calls_src = """
+(define (add a b) (+ a b))
+(define (loop n acc) (if (< n 1) acc (loop (- n 1) (add acc 1))))
+(define (total n) (if (< n 1) 0 (add n (total (- n 1)))))
+"""
+
+def bench_calls():
+    'A million small calls: builtins, a frameless function and tail calls'
+    env = new_env()
+    for ins in comp.compile_iterator(iter(source.String('calls', calls_src)), env):
+        env.eval_noexcept(ins)
+    # <, -, add, + and loop for each step
+    n = 200000
+    loop = comp.compile_expr(parse.parse_one(source.String('loop', '(loop %d 0)' % n)), env)
+    total = comp.compile_expr(parse.parse_one(source.String('total', '(total 20000)')), env)
+
+    tracemalloc.start()
+    env.eval_noexcept(total)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    seconds = timed(lambda: env.eval_noexcept(loop), repeat=3)
+    report('calls.small', seconds, calls=n * 5, ns_per_call='%.0f' % (seconds * 1e9 / (n * 5)),
+           total_peak_bytes=peak)
+
+callcc_src = """
+(define (captures n)
+  (if (< n 1)
+      0
+      (begin
+        (call/cc (lambda (k) (k 0)))
+        (captures (- n 1)))))
+(define (nest depth n) (if (< depth 1) (captures n) (+ 0 (nest (- depth 1) n))))
+(define (make-generator lst)
+  (define return false)
+  (define resume false)
+  (lambda ()
+    (call/cc (lambda (r)
+               (set! return r)
+               (if resume
+                   (resume false)
+                   (begin
+                     (for-each (lambda (x)
+                                 (call/cc (lambda (k)
+                                            (set! resume k)
+                                            (return x))))
+                               lst)
+                     (return false)))))))
+(define (drain g n) (if (g) (drain g (+ n 1)) n))
+(define (iota n acc) (if (< n 1) acc (iota (- n 1) (cons n acc))))
+"""
+
+def bench_callcc():
+    'Capturing continuations under deep recursion, and a generator built on them'
+    env = new_env()
+    basics.define_loops(env)
+    for ins in comp.compile_iterator(iter(source.String('callcc', callcc_src)), env):
+        env.eval_noexcept(ins)
+    n = 20000
+    for depth in [10, 1000]:
+        ins = comp.compile_expr(parse.parse_one(source.String('nest', '(nest %d %d)' % (depth, n))), env)
+        seconds = timed(lambda: env.eval_noexcept(ins))
+        report('callcc.capture_depth_%d' % depth, seconds, captures=n,
+               us_per_capture='%.1f' % (seconds * 1e6 / n))
+
+    drain = "(drain (make-generator (iota %d '())) 0)" % n
+    ins = comp.compile_expr(parse.parse_one(source.String('drain', drain)), env)
+    seconds = timed(lambda: env.eval_noexcept(ins))
+    report('callcc.generator', seconds, elements=n, us_per_element='%.1f' % (seconds * 1e6 / n))
+
+escape_src = """
+(define (search-ec x lst)
+  (call/ec (lambda (return)
+             (for-each (lambda (y) (if (equal? x y) (return y))) lst)
+             false)))
+(define (search-cc x lst)
+  (call/cc (lambda (return)
+             (for-each (lambda (y) (if (equal? x y) (return y))) lst)
+             false)))
+(define (search-rec x lst)
+  (if (null? lst) false (if (equal? x (car lst)) x (search-rec x (cdr lst)))))
+(define (repeat search n x lst) (if (< n 1) (search x lst) (begin (search x lst) (repeat search (- n 1) x lst))))
+(define (iota n acc) (if (< n 1) acc (iota (- n 1) (cons n acc))))
+(define numbers (iota 100000 '()))
+"""
+
+def bench_escape():
+    'Early exits from a search of a large list: call/ec, call/cc and a recursive search'
+    env = new_env()
+    basics.define_loops(env)
+    for ins in comp.compile_iterator(iter(source.String('escape', escape_src)), env):
+        env.eval_noexcept(ins)
+    n = 5000
+    results = {}
+    for name in ['rec', 'ec', 'cc']:
+        src = '(repeat search-%s %d 10 numbers)' % (name, n)
+        ins = comp.compile_expr(parse.parse_one(source.String('escape', src)), env)
+        results[name] = timed(lambda: env.eval_noexcept(ins))
+        report('escape.' + name, results[name], searches=n,
+               us_per_search='%.1f' % (results[name] * 1e6 / n),
+               vs_rec='%.2fx' % (results[name] / results['rec']))
+
+def bench_frames():
+    'Calls keeping locals on the value stack against calls allocating Locals'
+    env = new_env()
+    for ins in comp.compile_iterator(iter(source.String('frames', frames_src)), env):
+        env.eval_noexcept(ins)
+    funcs = [env.glob_const[name] for name in ['third', 'calls', 'count']]
+    calls = comp.compile_expr(parse.parse_one(source.String('calls', '(calls 20000)')), env)
+    count = comp.compile_expr(parse.parse_one(source.String('count', '(count 20000)')), env)
+
+    def set_frameless(frameless):
+        for func in funcs:
+            func.code = None
+            func.get_code()
+            if not frameless:
+                func.code = instr.finalize(func.ins)
+                func.frameless = False
+
+    def peak(ins):
+        tracemalloc.start()
+        env.eval_noexcept(ins)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+
+    results = {}
+    for frameless in [False, True]:
+        set_frameless(frameless)
+        results[frameless] = (timed(lambda: env.eval_noexcept(calls), repeat=5), peak(count))
+    report('frames.locals', results[False][0], count_peak_bytes=results[False][1])
+    report('frames.frameless', results[True][0], count_peak_bytes=results[True][1],
+           speedup='%.2fx' % (results[False][0] / results[True][0]))
+
+def bench_memo():
+    'Memoised pure functions against plain calls'
+    env = new_env()
+    ins = compile_src(env, 'fib', fib_src)
+    plain = timed(lambda: env.eval_noexcept(ins))
+
+    def memoised():
+        env.memo = function.Memo(1000)
+        env.eval_noexcept(ins)
+
+    memo_seconds = timed(memoised)
+    report('memo.plain', plain)
+    report('memo.memoised', memo_seconds, speedup='%.1fx' % (plain / memo_seconds),
+           hits=env.memo.hits, misses=env.memo.misses)
+
+benchmarks = {
+    'alloc': bench_alloc,
+    'cache': bench_cache,
+    'calls': bench_calls,
+    'callcc': bench_callcc,
+    'dispatch': bench_dispatch,
+    'equal': bench_equal,
+    'escape': bench_escape,
+    'frames': bench_frames,
+    'globals': bench_globals,
+    'locals': bench_locals,
+    'loops': bench_loops,
+    'memo': bench_memo,
+    'memory': bench_memory,
+    'mmap': bench_mmap,
+    'numeric': bench_numeric,
+    'parse': bench_parse,
+    'print': bench_print,
+    'stream': bench_stream,
+}
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(prog='bench', description='sprog benchmarks')
+    ap.add_argument('names', nargs='*', default=sorted(benchmarks))
+    args = ap.parse_args()
+
+    for name in args.names:
+        benchmarks[name]()
@@ -0,0 +1,203 @@
+
+import comp
+import function
+import source
+
+import hashlib
+import io
+import os
+import pickle
+import sys
+import weakref
+
+CACHE_DIR = '__sprogcache__'
+
+# Modules whose source decides what compiled code looks like
+compiler_modules = ['comp', 'cons', 'function', 'instr', 'optimize', 'parse', 'cache']
+
+compiler_version_hash = None
+
+def compiler_version():
+    "Hash of the compiler sources, so any compiler change invalidates the cache"
+    global compiler_version_hash
+    if not compiler_version_hash:
+        h = hashlib.sha256()
+        for name in compiler_modules:
+            with open(sys.modules[name].__file__, 'rb') as f:
+                h.update(f.read())
+        compiler_version_hash = h.hexdigest()
+    return compiler_version_hash
+
+# Hashes of the code of functions in glob_const, see code_hash()
+code_hashes = weakref.WeakKeyDictionary()
+
+def code_hash(func, env):
+    """Hash of the code of a function defined by an earlier file. Code compiled
+    against it may depend on it, e.g. the optimizer may inline its result"""
+    h = code_hashes.get(func, None)
+    if h is None:
+        f = io.BytesIO()
+        pickler = Pickler(f, env)
+        # Store the function itself by value, other constants by name
+        del pickler.consts[id(func)]
+        pickler.dump((func.ins, func.nargs, func.size, func.dotted))
+        h = code_hashes[func] = hashlib.sha256(f.getvalue()).hexdigest()
+    return h
+
+def cache_key(content, env, debuggable, optimizing):
+    h = hashlib.sha256()
+    h.update(compiler_version().encode())
+    h.update(repr((sorted(env.glob_const), debuggable, optimizing)).encode())
+    # Purity levels and, when optimizing, results of calls are compiled in.
+    # Builtins are covered by their names and purity, functions of earlier
+    # files by their code
+    for name, value in sorted(env.glob_const.items()):
+        if isinstance(value, function.Function):
+            h.update(repr((name, value.purity_level, code_hash(value, env))).encode())
+        elif hasattr(value, 'is_pure'):
+            h.update(repr((name, value.is_pure())).encode())
+    h.update(content)
+    return h.hexdigest()
+
+def cache_path(name, key):
+    d, base = os.path.split(os.path.abspath(name))
+    return os.path.join(d, CACHE_DIR, '%s.%s.pickle' % (base, key[:16]))
+
+class Pickler(pickle.Pickler):
+    "Pickles compiled code. Values from the environment are stored by name"
+    def __init__(self, f, env):
+        pickle.Pickler.__init__(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.env = env
+        self.refresh()
+
+    def refresh(self):
+        "Store functions defined by the forms run so far by name too"
+        self.consts = dict([(id(v), k) for k, v in self.env.glob_const.items()])
+
+    def persistent_id(self, obj):
+        name = self.consts.get(id(obj), None)
+        return ('const', name) if name is not None else None
+
+class Unpickler(pickle.Unpickler):
+    def __init__(self, f, env):
+        pickle.Unpickler.__init__(self, f)
+        self.env = env
+
+    def persistent_load(self, pid):
+        kind, name = pid
+        if kind != 'const' or name not in self.env.glob_const:
+            raise pickle.UnpicklingError('unknown constant: ' + str(name))
+        return self.env.glob_const[name]
+
+class Writer:
+    """Writes compiled forms to a cache entry as they are produced. The entry
+    only replaces the old one on commit(). Caching is best effort"""
+    def __init__(self, path, env):
+        self.path = path
+        self.tmp = path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.f = open(self.tmp, 'wb')
+            self.pickler = Pickler(self.f, env)
+        except OSError:
+            self.f = None
+
+    def write(self, ins):
+        if not self.f:
+            return
+        try:
+            self.pickler.refresh()
+            self.pickler.dump(ins)
+            # Forms do not share objects, except builtins which are stored
+            # by name. Forget them so memory use does not grow with the file
+            self.pickler.clear_memo()
+        except (OSError, pickle.PicklingError, RecursionError):
+            self.abort()
+
+    def commit(self):
+        "Make the entry visible, removing stale entries for the same source"
+        if not self.f:
+            return
+        d, base = os.path.split(self.path)
+        prefix = base.split('.')[:-2]
+        try:
+            self.f.close()
+            for old in os.listdir(d):
+                if old.split('.')[:-2] == prefix and old != base:
+                    os.remove(os.path.join(d, old))
+            os.replace(self.tmp, self.path)
+        except OSError:
+            pass
+        self.f = None
+
+    def abort(self):
+        if not self.f:
+            return
+        try:
+            self.f.close()
+            os.remove(self.tmp)
+        except OSError:
+            pass
+        self.f = None
+
+def load(path, key, env):
+    "Generator of the forms in a cache entry, None if there is no valid entry"
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    try:
+        if Unpickler(f, env).load() != key:
+            f.close()
+            return None
+    except (EOFError, pickle.UnpicklingError):
+        f.close()
+        return None
+
+    def forms():
+        # Each form was pickled with a fresh memo, so unpickle it with one
+        with f:
+            while True:
+                try:
+                    ins = Unpickler(f, env).load()
+                except EOFError:
+                    return
+                yield ins
+    return forms()
+
+def compile_and_store(name, env, debuggable, optimizing, path, key):
+    """Generator of compiled forms, written to the cache as they are taken.
+    The entry is only kept if all of them are"""
+    forms = comp.compile_iterator(iter(source.File(name)), env,
+                                  debuggable=debuggable, optimizing=optimizing)
+    writer = Writer(path, env)
+    writer.write(key)
+    try:
+        for ins in forms:
+            writer.write(ins)
+            yield ins
+    except BaseException:
+        # Including the caller stopping early. The rest of the file would be
+        # compiled without the forms before it having run, so no entry
+        writer.abort()
+        raise
+    writer.commit()
+
+def compile_file(name, env, debuggable=True, use_cache=True, optimizing=False):
+    """Compile a file, through the on-disk cache. Returns a generator of
+    compiled Instructions, one per top-level form, see comp.compile_iterator.
+    Cached code is keyed by file content, compiler version, the names defined
+    in env and the code of the functions among them. Tags are restored lazily, see source.CachedLine"""
+    if not use_cache:
+        return comp.compile_iterator(iter(source.File(name)), env,
+                                     debuggable=debuggable, optimizing=optimizing)
+
+    with open(name, 'rb') as f:
+        content = f.read()
+    key = cache_key(content, env, debuggable, optimizing)
+    path = cache_path(name, key)
+
+    forms = load(path, key, env)
+    if forms is None:
+        forms = compile_and_store(name, env, debuggable, optimizing, path, key)
+    return forms
@@ -16,14 +16,11 @@ def assert_symbol(sym):
         raise error.gen(Error, 'argument is not a symbol', data=sym)
 
 def get_load_literal(i):
+    "The value loaded by i if it is known at compile time, else None"
     if isinstance(i, instr.Load):
         if isinstance(i.loc, instr.LiteralLocation):
             return i.loc.value
-        elif (isinstance(i.loc, instr.UnknownLocation) or
-              isinstance(i.loc, instr.EnvSkipLocation) or
-              isinstance(i.loc, instr.LocalLocation)):
-            return None
-        else:
+        elif isinstance(i.loc, function.Function):
             return i.loc
     return None
 
@@ -345,6 +342,10 @@ class Block:
         self.iminsref_list = []
         self.dbg = dbg
 
+        # Global names unknown at compile time referred to by this function
+        # or functions inside it, see Env.resolve_unknowns()
+        self.unknown_references = {}
+
     def pop(self, ins=None, env=None):
         def resolve_iminsref_global(iml, env):
             constant = env.lookup_const(iml.sym)
@@ -355,7 +356,7 @@ class Block:
                     iml.i.loc = instr.LiteralLocation(constant)
             else:
                 iml.i.loc = instr.UnknownLocation(iml.sym)
-                iml.block.mark_func_nonpure()
+                iml.block.mark_func_nonpure(iml.sym)
             return True
 
         def resolve_all_iminsref_global(l):
@@ -562,16 +563,19 @@ class Block:
         return i
 
     def get_unknown_references(self):
-        #hack
-        return {}
+        # Filled in when the global block is popped
+        return self.unknown_references
 
-    def mark_func_nonpure(self):
+    def mark_func_nonpure(self, sym):
+        "sym is an unknown global referred to from this block"
         b = self
+        innermost = True
         while b:
             if b.block_type == Block.FUNC:
-                if b.func.purity_level == function.PURITY_LEVEL_PURE:
+                if innermost and b.func.purity_level == function.PURITY_LEVEL_PURE:
                     b.func.purity_level = function.PURITY_LEVEL_SHALLOW_ENV
-                return
+                innermost = False
+                b.unknown_references[sym.symbol] = None
             b = b.parent
 
     def __str__(self):
@@ -651,229 +655,255 @@ class ExpressionCompiler:
 
         self.push_ins()
 
-        for expr in cons_util.traverse_list(body):
-            self.compile_expr(expr)
+        exprs = [x for x in cons_util.traverse_tagged(body)]
+        for index, (expr, expr_tag) in enumerate(exprs):
+            self.compile_expr(expr, tail=(index == len(exprs) - 1), tag=expr_tag)
 
         block = self.block
         self.block = self.block.pop(self.pop_ins())
         return block
 
-    def compile_literal(self, literal):
+    def compile_literal(self, literal, tag=None):
         if not literal:
             raise Exception('no value')
-        self.add(instr.Load(instr.LiteralLocation(literal)), debug_data=literal)
+        self.add(instr.Load(instr.LiteralLocation(literal)), debug_data=literal, tag=tag)
         return literal
 
-    def compile_load(self, sym):
+    def compile_load(self, sym, tag=None):
         "Load a variable"
-        self.add(self.block.get_load_instr(sym, self.ins), debug_data=sym)
+        self.add(self.block.get_load_instr(sym, self.ins), tag=tag)
 
-    def compile_store(self, head, args):
+    def compile_store(self, head, args, tag=None):
         "define, set!, etc"
-        arglist = [x for x in cons_util.traverse_list(args)]
+        arglist = [x for x in cons_util.traverse_tagged(args)]
         if len(arglist) != 2:
-            raise error.gen(Error, 'wrong number of arguments to set!', data=head)
-        sym = arglist[0]
+            raise error.gen(Error, 'wrong number of arguments to set!', data=head, tag=tag)
+        (sym, sym_tag) = arglist[0]
         assert_symbol(sym)
-        self.compile_expr(arglist[1])
+        self.compile_expr(*arglist[1])
 
-        self.add(self.block.get_store_instr(sym, self.ins, True), debug_data=sym)
+        self.add(self.block.get_store_instr(sym, self.ins, True), tag=sym_tag)
 
-    def compile_call(self, func, args):
-        self.add(instr.PushArgs(), debug_data=func)
+    def compile_call(self, func, args, tail=False, tag=None):
+        self.add(instr.PushArgs(), debug_data=func, tag=tag)
         nparams = 0
-        for arg in cons_util.traverse_list(args):
-            self.compile_expr(arg)
-            self.add(instr.Arg(), debug_data=arg)
+        for (arg, arg_tag) in cons_util.traverse_tagged(args):
+            self.compile_expr(arg, tag=arg_tag)
+            self.add(instr.Arg(), debug_data=arg, tag=arg_tag)
             nparams += 1
-        self.compile_expr(func)
-        self.add(instr.Call(nparams), debug_data=func)
+        self.compile_expr(func, tag=tag)
+        if tail:
+            self.add(instr.TailCall(nparams), debug_data=func, tag=tag)
+        else:
+            self.add(instr.Call(nparams), debug_data=func, tag=tag)
 
-    def compile_call_cc(self, head, args):
+    def compile_call_cc(self, head, args, tag=None):
+        "call/cc or call/ec"
         # no need for PushArgs
-        arglist = [x for x in cons_util.traverse_list(args)]
+        arglist = [x for x in cons_util.traverse_tagged(args)]
         if len(arglist) != 1:
-            raise error.gen(Error, 'call/cc takes one argument', data=head)
-        self.compile_expr(arglist[0])
-        self.add(instr.CallCC(), debug_data=head)
+            raise error.gen(Error, head.symbol + ' takes one argument', data=head, tag=tag)
+        self.compile_expr(*arglist[0])
+        if head.symbol == 'call/ec':
+            self.add(instr.CallEC(), tag=tag)
+        else:
+            self.add(instr.CallCC(), tag=tag)
 
-    def compile_lambda(self, head, args):
+    def compile_lambda(self, head, args, tag=None):
         func = function.Function()
         loc = func
-        self.function_block(func, args.car, args.cdr, getattr(head, 'tag', None))
+        self.function_block(func, args.car, args.cdr, tag)
         if func.purity_level == function.PURITY_LEVEL_DEEP_ENV:
             # Add skip location to force environment pickup
             self.dbg.d('deep env for lambda ', str(func), 'level: ', func.purity_level)
             loc = instr.EnvSkipLocation(func, 0)
-        self.add(instr.Load(loc), debug_data=head)
+        self.add(instr.Load(loc), tag=tag)
 
-    def compile_define(self, head, args):
+    def compile_define(self, head, args, tag=None):
         if not isinstance(args, cons.Pair):
-            raise error.gen(Error, 'no symbol', data=head)
+            raise error.gen(Error, 'no symbol', data=head, tag=tag)
 
         if isinstance(args.car, cons.Pair):
             # special function syntax
             sym = args.car.car
-            tag = getattr(sym, 'tag', None)
+            sym_tag = getattr(args.car, 'tag', tag)
             func = function.Function()
 
             # Define function name in the symbol table - can be referenced directly
             self.block.define_constant(sym, func)
 
-            func_block = self.function_block(func, args.car.cdr, args.cdr, tag)
+            func_block = self.function_block(func, args.car.cdr, args.cdr, sym_tag)
 
             if self.block.block_type == Block.GLOBAL:
                 # Compiling a global define in a non-module: Need instructions
-                self.add(instr.Load(func), debug_data=sym)
+                self.add(instr.Load(func), tag=sym_tag)
                 self.add(instr.Store(instr.GlobalFunctionLocation(sym, func_block.get_unknown_references())))
         else:
             if isinstance(args.cdr, cons.Pair):
-                constant = self.compile_nonconstant_expr(args.cdr.car)
+                constant = self.compile_nonconstant_expr(args.cdr.car, tag=getattr(args.cdr, 'tag', None))
             else:
-                constant = cons.Void()
+                constant = cons.VOID
 
             if constant:
                 self.block.define_value(args.car, constant)
             else:
                 self.block.define(args.car)
 
-            self.add(self.block.get_store_instr(args.car, self.ins, False))
+            self.add(self.block.get_store_instr(args.car, self.ins, False), tag=getattr(args, 'tag', None))
 
-    def compile_begin(self, head, args):
+    def compile_begin(self, head, args, tail=False, tag=None):
         # (begin ...) can contain definitions
-        self.block = Block(Block.SCOPE, self.block, self.dbg, tag=getattr(head, 'tag', None))
-        for expr in cons_util.traverse_list(args):
-            self.compile_expr(expr)
+        self.block = Block(Block.SCOPE, self.block, self.dbg, tag=tag)
+        exprs = [x for x in cons_util.traverse_tagged(args)]
+        for index, (expr, expr_tag) in enumerate(exprs):
+            self.compile_expr(expr, tail=(tail and index == len(exprs) - 1), tag=expr_tag)
         self.block = self.block.pop()
 
-    def compile_if(self, head, args):
-        lst = [x for x in cons_util.traverse_list(args)]
+    def compile_if(self, head, args, tail=False, tag=None):
+        lst = [x for x in cons_util.traverse_tagged(args)]
         if len(lst) == 0:
-            raise error.gen(Error, 'empty if', data=lst)
+            raise error.gen(Error, 'empty if', tag=tag)
         elif len(lst) == 1:
-            raise error.gen(Error, 'if: missing true clause', data=lst[0])
+            raise error.gen(Error, 'if: missing true clause', data=lst[0][0], tag=lst[0][1])
         elif len(lst) == 2 or len(lst) == 3:
-            constant = self.compile_nonconstant_expr(lst[0])
+            constant = self.compile_nonconstant_expr(lst[0][0], tag=lst[0][1])
             if not constant:
                 g = ExclDefineGroup(self.block)
-                true = self.compile_ins(lst[1])
+                true = self.compile_ins(lst[1][0], tail, lst[1][1])
                 g.advance()
-                false = self.compile_ins(lst[2] if len(lst) == 3 else cons.Void())
+                (false_expr, false_tag) = lst[2] if len(lst) == 3 else (cons.VOID, tag)
+                false = self.compile_ins(false_expr, tail, false_tag)
                 g.end()
-                self.add(instr.If(true, false), debug_data=head)
+                self.add(instr.If(true, false), tag=tag)
             elif cons.is_false(constant):
                 if len(lst) == 3:
-                    self.compile_expr(lst[2])
+                    self.compile_expr(lst[2][0], tail, lst[2][1])
                 else:
-                    self.compile_literal(cons.Void())
+                    self.compile_literal(cons.VOID, tag)
             else:
-                self.compile_expr(lst[1])
+                self.compile_expr(lst[1][0], tail, lst[1][1])
         else:
-            raise error.gen(Error, 'too many if clauses', data=lst[3])
+            raise error.gen(Error, 'too many if clauses', data=lst[3][0], tag=lst[3][1])
 
-    def compile_and(self, head, args):
+    def compile_and(self, head, args, tail=False, tag=None):
         def comp_rec(p, n):
-            if isinstance(p, cons.Null):
-                return None
+            p_tag = getattr(p, 'tag', tag)
+            if isinstance(p.cdr, cons.Null):
+                # The last expression gives the value
+                self.compile_expr(p.car, tail, p_tag)
             else:
-                constant = self.compile_nonconstant_expr(p.car)
+                constant = self.compile_nonconstant_expr(p.car, tag=p_tag)
                 if constant:
-                    self.compile_literal(constant)
+                    self.compile_literal(constant, p_tag)
                     if cons.is_false(constant):
                         return
 
                 self.push_ins()
                 comp_rec(p.cdr, n+1)
-                self.add(instr.If(self.pop_ins(), None))
+                self.add(instr.If(self.pop_ins(), None), tag=p_tag)
 
         if isinstance(args, cons.Null):
-            self.compile_literal(cons.false())
+            self.compile_literal(cons.FALSE, tag)
         else:
             comp_rec(args, 0)
 
-    def compile_or(self, head, args):
+    def compile_or(self, head, args, tail=False, tag=None):
         def comp_rec(p, n):
-            if isinstance(p, cons.Null):
-                return None
+            p_tag = getattr(p, 'tag', tag)
+            if isinstance(p.cdr, cons.Null):
+                # The last expression gives the value
+                self.compile_expr(p.car, tail, p_tag)
             else:
-                constant = self.compile_nonconstant_expr(p.car)
+                constant = self.compile_nonconstant_expr(p.car, tag=p_tag)
                 if constant:
-                    self.compile_literal(constant)
+                    self.compile_literal(constant, p_tag)
                     if not cons.is_false(constant):
                         return
 
                 self.push_ins()
                 comp_rec(p.cdr, n+1)
-                self.add(instr.If(None, self.pop_ins()))
+                self.add(instr.If(None, self.pop_ins()), tag=p_tag)
 
         if isinstance(args, cons.Null):
-            self.compile_literal(cons.true())
+            self.compile_literal(cons.TRUE, tag)
         else:
             comp_rec(args, 0)
 
-    def compile_list(self, head, args):
+    def compile_list(self, head, args, tail=False, tag=None):
         if not isinstance(head, cons.Symbol):
-            self.compile_call(head, args)
+            self.compile_call(head, args, tail, tag)
         elif head.symbol == 'and':
-            self.compile_and(head, args)
+            self.compile_and(head, args, tail, tag)
         elif head.symbol == 'begin':
-            self.compile_begin(head, args)
-        elif head.symbol == 'call/cc':
-            self.compile_call_cc(head, args)
+            self.compile_begin(head, args, tail, tag)
+        elif head.symbol == 'call/cc' or head.symbol == 'call/ec':
+            self.compile_call_cc(head, args, tag)
         elif head.symbol == 'define':
-            self.compile_define(head, args)
+            self.compile_define(head, args, tag)
         elif head.symbol == 'if':
-            self.compile_if(head, args)
+            self.compile_if(head, args, tail, tag)
         elif head.symbol == 'lambda':
-            self.compile_lambda(head, args)
+            self.compile_lambda(head, args, tag)
         elif head.symbol == 'or':
-            self.compile_or(head, args)
+            self.compile_or(head, args, tail, tag)
         elif head.symbol == 'set!':
-            self.compile_store(head, args)
+            self.compile_store(head, args, tag)
         else:
-            self.compile_call(head, args)
+            self.compile_call(head, args, tail, tag)
 
-    def compile_expr(self, e):
-        'Generate opcodes for an expression'
+    def compile_expr(self, e, tail=False, tag=None):
+        """Generate opcodes for an expression
+        tail -- whether the expression is in tail position of a function body
+        tag -- source position of e, used when e is untagged. Interned atoms
+               get their position from the enclosing list cell"""
         self.block.nesting_level += 1
+        tag = getattr(e, 'tag', tag)
         if isinstance(e, cons.Pair):
-            self.compile_list(e.car, e.cdr)
+            self.compile_list(e.car, e.cdr, tail, tag)
         elif isinstance(e, cons.Symbol):
             if cons.is_true(e) or cons.is_false(e):
-                self.compile_literal(e)
+                self.compile_literal(e, tag)
             else:
-                self.compile_load(e)
+                self.compile_load(e, tag)
         elif isinstance(e, cons.Quote):
-            self.compile_literal(e.value)
+            self.compile_literal(e.value, tag)
         else:
-            self.compile_literal(e)
+            self.compile_literal(e, tag)
         self.block.nesting_level -= 1
 
-    def compile_nonconstant_expr(self, e, undo_index=None):
+    def compile_nonconstant_expr(self, e, undo_index=None, tag=None):
         "Generate code only if non-constant expression. Return constant if constant"
         undo_index = undo_index if undo_index else len(self.ins)
         current_index = len(self.ins)
-        self.compile_expr(e)
+        self.compile_expr(e, tag=tag)
         if len(self.ins) == current_index + 1:
-            lit = get_load_literal(self.ins[current_index])
+            lit = get_load_literal(self.ins[current_index]) or self.get_global_const(self.ins[current_index])
             if lit:
                 self.undo(undo_index)
                 return lit
 
         return None
 
-    def compile_add_nonconstant_expr(self, e):
+    def get_global_const(self, i):
+        """The constant loaded by i, if it is a global defined by an earlier
+        form, see compile_iterator. None otherwise"""
+        if (isinstance(i, instr.Load) and isinstance(i.loc, GlobalPlaceholderLocation) and
+            i.loc.value is None and self.env):
+            return self.env.lookup_const(i.loc.sym)
+        return None
+
+    def compile_add_nonconstant_expr(self, e, tag=None):
         "Generate code expression code. Return constant if constant, None if nonconstant."
-        constant = self.compile_nonconstant_expr(e)
+        constant = self.compile_nonconstant_expr(e, tag=tag)
         if constant:
-            self.compile_literal(constant)
+            self.compile_literal(constant, tag)
             return constant
         else:
             return False
 
-    def compile_ins(self, e):
+    def compile_ins(self, e, tail=False, tag=None):
         self.push_ins()
-        self.compile_expr(e)
+        self.compile_expr(e, tail, tag)
         return self.pop_ins()
 
     def compile_global(self, e):
@@ -899,10 +929,14 @@ class CPSTest:
         pass
 
 
-def compiler_chain(env, debuggable=True):
-    chain = [ExpressionCompiler(env, debuggable=debuggable)]
-    #chain.append(optimize.PurityOptimizer(env, verbose=verbose))
-    #chain.append(optimize.CallOptimizer(env, verbose=verbose))
+def compiler_chain(env, debuggable=True, optimizing=False):
+    """The purity analysis always runs, so Function.is_pure() can be trusted.
+    optimizing -- run the optimizer passes after it"""
+    verbose = env.dbg.comp.enabled
+    chain = [ExpressionCompiler(env, debuggable=debuggable),
+             optimize.PurityOptimizer(env, verbose=verbose)]
+    if optimizing:
+        chain.append(optimize.CallOptimizer(env, verbose=verbose))
     return chain
 
 def run_chain(chain, expr, dbg):
@@ -913,10 +947,10 @@ def run_chain(chain, expr, dbg):
         dbg.dump(result)
     return result
 
-def compile_module(i, env, debuggable=True):
+def compile_module(i, env, debuggable=True, optimizing=False):
     # add all instructions
     dbg = env.dbg.comp
-    chain = compiler_chain(env, debuggable=debuggable)
+    chain = compiler_chain(env, debuggable=debuggable, optimizing=optimizing)
     main = chain[0]
     main.push_module()
     while True:
@@ -930,14 +964,21 @@ def compile_module(i, env, debuggable=True):
     dbg.dump(ins)
     return run_chain(chain[1:], ins, dbg)
 
-def compile_expr(expr, env, debuggable=True):
-    chain = compiler_chain(env, debuggable=debuggable)
+def compile_expr(expr, env, debuggable=True, optimizing=False):
+    chain = compiler_chain(env, debuggable=debuggable, optimizing=optimizing)
     return run_chain(chain, expr, env.dbg.comp)
 
-def compile_iterator(i, env, debuggable=True):
-    chain = compiler_chain(env, debuggable=debuggable)
+def compile_iterator(i, env, debuggable=True, optimizing=False):
+    """Generate compiled Instructions for each top-level form of the char
+    iterator i, parsing a form only when the previous one has been taken.
+    The parser and compiler chain are shared by all forms"""
+    chain = compiler_chain(env, debuggable=debuggable, optimizing=optimizing)
+    dbg = env.dbg.comp
+    parser = parse.Parser()
+    next_token = parse.Tokenizer(i).next
     while True:
         try:
-            yield run_chain(parse.parse_iterator(i), env, env.dbg.comp, debuggable)
+            expr = parser.parse(next_token)
         except parse.NoValueError:
             return
+        yield run_chain(chain, expr, dbg)
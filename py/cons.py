@@ -1,9 +1,17 @@
 
 import debug
+import printer
 
 import numbers
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Base:
+    __slots__ = ()
+
     def __str__(self):
         s = self.__class__.__name__ + '<' + self.sexpr() + '>'
         if hasattr(self, 'tag'):
@@ -20,11 +28,14 @@ class Base:
         return self.eq(value)
 
 class Null(Base):
-    def __init__(self):
-        pass
+    "The empty list. Null() always returns the same object"
+    __slots__ = ()
 
-    def eq(self, value):
-        return value.__class__ is Null
+    def __new__(cls):
+        return NULL
+
+    def __reduce__(self):
+        return (Null, ())
 
     def sexpr(self):
         return '()'
@@ -33,38 +44,46 @@ class Null(Base):
         return ()
 
 class Pair(Base):
+    """Pairs are not changed once built, so their structural hash is
+    cached in hash_value, see structural_hash()"""
+    __slots__ = ('car', 'cdr', 'tag', 'hash_value')
+
     def __init__(self, car, cdr):
         self.car = car
         self.cdr = cdr
+        self.hash_value = None
+
+    def __getstate__(self):
+        # Hashes of symbols, and so of lists, differ between processes
+        state = {'car': self.car, 'cdr': self.cdr, 'hash_value': None}
+        if hasattr(self, 'tag'):
+            state['tag'] = self.tag
+        return (None, state)
 
     def equal(self, value):
-        return value.__class__ is Pair and self.car.equal(value.car) and self.cdr.equal(value.cdr)
+        return equal(self, value)
 
     def sexpr(self):
-        i = self
-        s = '('
-        while True:
-            s += i.car.sexpr()
-            cdr = i.cdr
-            if isinstance(cdr, Null):
-                break
-            elif isinstance(cdr, Pair):
-                s += ' '
-                i = cdr
-            else:
-                s += ' . ' + cdr.sexpr()
-                break
-        return s + ')'
+        return printer.sexpr(self)
 
     def fields(self):
         return (self.car, self.cdr)
 
 class Symbol(Base):
-    def __init__(self, symbol):
-        self.symbol = symbol
+    """Symbols are interned: there is one Symbol object per name, so they
+    compare by identity. Being shared, symbols carry no source tags"""
+    __slots__ = ('symbol',)
+
+    def __new__(cls, symbol):
+        s = symbols.get(symbol, None)
+        if s is None:
+            s = Base.__new__(cls)
+            s.symbol = symbol
+            symbols[symbol] = s
+        return s
 
-    def eq(self, value):
-        return value.__class__ is Symbol and self.symbol == value.symbol
+    def __reduce__(self):
+        return (Symbol, (self.symbol,))
 
     def sexpr(self):
         return self.symbol
@@ -73,16 +92,24 @@ class Symbol(Base):
         return ()
 
 class Void(Base):
+    "Void() always returns the same object"
+    __slots__ = ()
+
+    def __new__(cls):
+        return VOID
+
+    def __reduce__(self):
+        return (Void, ())
+
     def sexpr(self):
         return '#void'
 
-    def eq(self, value):
-        return value.__class__ is Void
-
     def fields(self):
         return ()
 
 class Number(Base):
+    __slots__ = ('number', 'tag')
+
     def __init__(self, n):
         self.number = n
 
@@ -96,6 +123,8 @@ class Number(Base):
         return ()
 
 class String(Base):
+    __slots__ = ('string', 'tag')
+
     def __init__(self, string):
         self.string = string
 
@@ -109,32 +138,227 @@ class String(Base):
         return ()
 
 class Quote(Base):
+    __slots__ = ('value', 'tag')
+
     def __init__(self, value):
         self.value = value
 
+    def equal(self, value):
+        return equal(self, value)
+
     def sexpr(self):
-        return "'" + self.value.sexpr()
+        return printer.sexpr(self)
 
     def fields(self):
         return [self.value]
 
+class Vector(Base):
+    "Array of values, with O(1) access by index"
+    __slots__ = ('items', 'tag')
+
+    def __init__(self, items):
+        self.items = items
+
+    def check_index(self, index):
+        if index.__class__ is not Number or not 0 <= index.number < len(self.items):
+            raise IndexError('vector index out of range: ' + index.sexpr())
+        return index.number
+
+    def ref(self, index):
+        return self.items[self.check_index(index)]
+
+    def set(self, index, value):
+        self.items[self.check_index(index)] = value
+        return VOID
+
+    def equal(self, value):
+        return equal(self, value)
+
+    def sexpr(self):
+        return printer.sexpr(self)
+
+    def fields(self):
+        return list(self.items)
+
+class Array(Base):
+    """Numeric array backed by a NumPy array, which it shares rather than
+    copies. Arithmetic builtins work on whole arrays, see basics.
+    Only usable if numpy is installed"""
+    __slots__ = ('array', 'tag')
+
+    def __init__(self, array):
+        self.array = array
+
+    def equal(self, value):
+        return value.__class__ is Array and bool(numpy.array_equal(self.array, value.array))
+
+    def sexpr(self):
+        return '#array(' + ' '.join([from_py(x).sexpr() for x in self.array.tolist()]) + ')'
+
+    def fields(self):
+        return ()
+
+def eqv_key(value):
+    "Dict key comparing like eqv?: numbers by value and exactness, the rest by identity"
+    if value.__class__ is Number:
+        n = value.number
+        return (Number, n.__class__, n)
+    return value
+
+class HashTable(Base):
+    """Hash table keyed by equal? or eqv?, see Key and eqv_key().
+    Keys must not be changed while in the table"""
+    __slots__ = ('key', 'entries')
+
+    def __init__(self, eqv=False):
+        self.key = eqv_key if eqv else Key
+        # key -> (key value, value)
+        self.entries = {}
+
+    def ref(self, key, default=None):
+        entry = self.entries.get(self.key(key), None)
+        if entry is not None:
+            return entry[1]
+        elif default is None:
+            raise KeyError('hash table has no key ' + key.sexpr())
+        return default
+
+    def set(self, key, value):
+        self.entries[self.key(key)] = (key, value)
+        return VOID
+
+    def sexpr(self):
+        return '#hash' + printer.sexpr(lst(*[Pair(k, v) for (k, v) in self.entries.values()]))
+
+    def fields(self):
+        return [x for entry in self.entries.values() for x in entry]
+
+symbols = {}
+
+NULL = Base.__new__(Null)
+VOID = Base.__new__(Void)
+TRUE = Symbol('true')
+FALSE = Symbol('false')
+
+def equal(a, b):
+    """equal? without recursion. Shared structure is skipped by identity,
+    and lists with different cached hashes are unequal without a walk"""
+    stack = [(a, b)]
+    while stack:
+        (a, b) = stack.pop()
+        while a is not b:
+            cls = a.__class__
+            if cls is not b.__class__:
+                return False
+            if cls is Pair:
+                ha = a.hash_value
+                if ha is not None:
+                    hb = b.hash_value
+                    if hb is not None and ha != hb:
+                        return False
+                ca = a.car
+                cb = b.car
+                if ca is not cb:
+                    ccls = ca.__class__
+                    if ccls is Pair or ccls is Quote:
+                        stack.append((ca, cb))
+                    elif ccls is not cb.__class__ or not ca.equal(cb):
+                        return False
+                a = a.cdr
+                b = b.cdr
+            elif cls is Quote:
+                a = a.value
+                b = b.value
+            elif cls is Vector:
+                if len(a.items) != len(b.items):
+                    return False
+                stack.extend(zip(a.items, b.items))
+                break
+            elif a.equal(b):
+                break
+            else:
+                return False
+    return True
+
+def structural_hash(value):
+    """Hash consistent with equal?, computed without recursion.
+    Hashes of pairs are cached, so hashing a list again is O(1)"""
+    # Values to hash, and pairs and quotes whose parts have been hashed
+    stack = [(value, False)]
+    hashes = []
+    while stack:
+        (value, done) = stack.pop()
+        cls = value.__class__
+        if cls is Pair:
+            if done:
+                h = hash((hashes.pop(-2), hashes.pop()))
+                value.hash_value = h
+                hashes.append(h)
+                continue
+            h = value.hash_value
+            if h is None:
+                stack.append((value, True))
+                stack.append((value.cdr, False))
+                stack.append((value.car, False))
+                continue
+        elif cls is Quote:
+            if done:
+                h = hash((Quote, hashes.pop()))
+            else:
+                stack.append((value, True))
+                stack.append((value.value, False))
+                continue
+        elif cls is Vector:
+            # Vectors change, their lengths do not
+            h = hash((Vector, len(value.items)))
+        elif cls is Array:
+            h = hash((Array, value.array.shape))
+        elif cls is Number:
+            h = hash(value.number)
+        elif cls is String:
+            h = hash(value.string)
+        else:
+            # Compared by identity
+            h = hash(value)
+        hashes.append(h)
+    return hashes[0]
+
+class Key:
+    """Wraps a value to be used as a dict key: keys are compared with
+    equal? and hashed by structure. Lists are shared, not copied"""
+    __slots__ = ('value', 'hash_value')
+
+    def __init__(self, value):
+        self.value = value
+        self.hash_value = structural_hash(value)
+
+    def __hash__(self):
+        return self.hash_value
+
+    def __eq__(self, other):
+        return (other.__class__ is Key and self.hash_value == other.hash_value and
+                equal(self.value, other.value))
+
+    def __repr__(self):
+        return 'Key(' + self.value.sexpr() + ')'
+
 def lst(*args):
-    p = Null()
+    p = NULL
     for x in reversed(args):
         p = Pair(from_py(x), p)
     return p
 
 def true():
-    return Symbol('true')
+    return TRUE
 
 def false():
-    return Symbol('false')
+    return FALSE
 
 def is_true(cons):
-    return not isinstance(cons, Symbol) or cons.symbol == 'true'
+    return cons is TRUE or not isinstance(cons, Symbol)
 
 def is_false(cons):
-    return isinstance(cons, Symbol) and cons.symbol == 'false'
+    return cons is FALSE
 
 def debug_str(c):
     d = '#' + c.__class__.__name__
@@ -146,11 +370,17 @@ def from_py(value):
     if isinstance(value, Base):
         return value
     elif isinstance(value, bool):
-        return true() if value else false()
+        return TRUE if value else FALSE
     elif isinstance(value, numbers.Number):
+        if numpy is not None and isinstance(value, numpy.generic):
+            value = value.item()
         return Number(value)
     elif isinstance(value, list) or isinstance(value, tuple):
         return lst(*value)
+    elif numpy is not None and isinstance(value, numpy.ndarray):
+        return Array(value)
+    elif numpy is not None and isinstance(value, numpy.bool_):
+        return TRUE if value else FALSE
     else:
         raise Exception('unable to interpret value: ', str(value))
 
@@ -161,5 +391,7 @@ def to_py(cons):
         return cons.number
     elif isinstance(cons, Symbol):
         return cons.symbol
+    elif isinstance(cons, Array):
+        return cons.array
     else:
         raise Exception('unable to interpret value: ', cons.sexpr())
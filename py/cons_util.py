@@ -12,6 +12,18 @@ def traverse_list(p):
         else:
             raise error.Error('malformed list', data=p)
 
+def traverse_tagged(p):
+    """Like traverse_list, but yields (element, tag) where the tag is taken
+    from the list cell, since interned elements are untagged"""
+    while True:
+        if isinstance(p, cons.Pair):
+            yield (p.car, getattr(p, 'tag', None))
+            p = p.cdr
+        elif isinstance(p, cons.Null):
+            return
+        else:
+            raise error.Error('malformed list', data=p)
+
 def traverse(cons):
     stack = [cons]
     while stack:
@@ -23,7 +23,7 @@ def e(*what):
 """
 
 def point_to_tag(tag):
-    return tag[0].line_str + ('~' * (tag[1] - 1)) + '^' if tag else ''
+    return tag[0].line_str.rstrip('\n') + '\n' + ('~' * (tag[1] - 1)) + '^' if tag else ''
 
 def describe_tag(tag):
     return ':'.join([tag[0].sourcefile.name, str(tag[0].row), str(tag[1])]) if tag else ''
@@ -106,6 +106,17 @@ def stream_tree():
     r.add('eval')
     return r
 
+class InsCounter(StreamTree):
+    'Eval debug stream that only counts executed instructions'
+    def __init__(self):
+        StreamTree.__init__(self, 'eval', None)
+        self.enabled = True
+        self.count = 0
+
+    def d(self, *what):
+        if len(what) and what[0] == 'ins: ':
+            self.count += 1
+
 class Dumper:
     """
     Dumper for object trees - for objects implementing the hvtree() method.
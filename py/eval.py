@@ -4,40 +4,60 @@ import debug
 import error
 import function
 import instr
+import optimize
 
 import copy
 
+class StepLimitError(error.Error):
+    pass
+
 class ExecEnv:
+    """Execution state. The saved instructions and locals are linked
+    tuples that are never changed, and values on the stack are frozen
+    before a continuation is captured, see freeze(). So a copy of an
+    ExecEnv is a continuation, and capturing one takes constant time"""
     # cached
     pop_local = instr.Instructions()
     pop_local.append(instr.PopLocals())
+    pop_stack = instr.Instructions()
+    pop_stack.append(instr.PopStack())
 
     def __init__(self, ins):
-        # Results and arguments
-        self.values = []
-
         # Result register
         self.value = None
 
         # Programs and program counter
         self.ins = ins
         self.pc = 0
-        self.ins_pc_stack = []
+        # (ins, pc, rest) of the instructions to return to, None if empty
+        self.ins_pc_stack = None
 
         # Function environments
         self.local = None
-        self.local_stack = []
+        # (local, rest), None if empty
+        self.local_stack = None
+
+        # Value stack: arguments of calls being set up, see apply_stack(),
+        # and locals of frameless functions, see push_stack_frame()
+        self.stack = []
+        self.base = 0
+        self.base_stack = []
+        # (values, end, rest) of values below self.stack, values[:end] are
+        # in use. Never changed, see freeze()
+        self.frozen = None
 
         # Function calling
-        self.args = []
-        self.args_stack = []
+        self.tail = False
+
+        # Innermost Escape whose call/ec has not returned, see Escape.outer
+        self.escape = None
 
     def __next__(self):
         while self.pc == len(self.ins):
-            if len(self.ins_pc_stack) == 0:
+            if self.ins_pc_stack is None:
                 raise StopIteration
             else:
-                (self.ins, self.pc) = self.ins_pc_stack.pop()
+                (self.ins, self.pc, self.ins_pc_stack) = self.ins_pc_stack
 
         i = self.ins[self.pc]
         self.pc += 1
@@ -47,25 +67,124 @@ class ExecEnv:
         if ins:
             if self.pc < len(self.ins):
                 #debug.d('push ins, pc=', self.pc)
-                self.ins_pc_stack.append((self.ins, self.pc))
+                self.ins_pc_stack = (self.ins, self.pc, self.ins_pc_stack)
             self.ins = ins
             self.pc = 0
 
     def push_local_autopop(self, local):
-        self.local_stack.append(self.local)
+        self.local_stack = (self.local, self.local_stack)
         self.local = local
         self.push_ins(self.pop_local)
 
-    def pop_args(self):
-        args = self.args
-        self.args = self.args_stack.pop()
-        return args
+    def pop_local_stack(self):
+        (self.local, self.local_stack) = self.local_stack
+
+    def is_frame_done(self):
+        "Whether the current function frame has no instructions left but its PopLocals or PopStack"
+        if self.pc == len(self.ins) and self.ins_pc_stack is not None:
+            top = self.ins_pc_stack[0]
+            return top is self.pop_local or top is self.pop_stack
+        return False
 
-    def apply_function(self, env, args=None):
+    def depth(self):
+        "Number of saved instruction lists and locals"
+        n = 0
+        for linked in [self.ins_pc_stack, self.local_stack]:
+            while linked is not None:
+                linked = linked[-1]
+                n += 1
+        return n
+
+    def push_frame(self, local, ins):
+        "Enter a function body with its own local environment"
+        if self.tail and self.is_frame_done():
+            # Tail call: nothing is left of the current frame, replace it
+            if self.ins_pc_stack[0] is self.pop_local:
+                self.local = local
+                self.push_ins(ins)
+                return
+            self.ins_pc_stack = self.ins_pc_stack[2]
+            self.pop_stack_frame()
+        self.push_local_autopop(local)
+        self.push_ins(ins)
+
+    def push_stack_frame(self, n, padding, ins):
+        """Enter the body of a frameless function. Its n arguments on top of
+        self.stack become its first locals, padding is pushed for the rest.
+        self.base is the index of the first local"""
+        stack = self.stack
+        start = len(stack) - n
+        if self.tail and self.is_frame_done():
+            if self.ins_pc_stack[0] is self.pop_stack:
+                # Tail call: the arguments replace the current stack frame
+                del stack[self.base:start]
+                stack += padding
+                self.push_ins(ins)
+                return
+            self.ins_pc_stack = self.ins_pc_stack[2]
+            self.pop_local_stack()
+        self.base_stack.append(self.base)
+        self.base = start
+        stack += padding
+        self.push_ins(self.pop_stack)
+        self.push_ins(ins)
+
+    def pop_stack_frame(self):
+        del self.stack[self.base:]
+        self.base = self.base_stack.pop()
+
+    def move_stack_range(self, start, end, positions):
+        "Locals.move_range() for the current stack frame"
+        stack = self.stack
+        base = self.base
+        items = stack[base + start:base + end]
+        del stack[base + start:base + end]
+        stack[base + start + positions:base + start + positions] = items
+
+    def freeze(self):
+        """Move the values on the stack below it, where they are never
+        changed, so they can be shared with a continuation.
+        No frameless function is running when a continuation is captured,
+        so the stack only holds arguments"""
+        if self.stack:
+            self.frozen = (self.stack, len(self.stack), self.frozen)
+            self.stack = []
+
+    def thaw(self, n):
+        "Copy frozen values to the stack until it holds at least n"
+        stack = self.stack
+        while len(stack) < n:
+            (values, end, rest) = self.frozen
+            count = min(n - len(stack), end)
+            stack[0:0] = values[end - count:end]
+            self.frozen = (values, end - count, rest) if end > count else rest
+
+    def pop_values(self, n, padding=()):
+        "Remove the top n values of the stack, returned as a list followed by padding"
+        stack = self.stack
+        start = len(stack) - n
+        values = stack[start:]
+        del stack[start:]
+        values += padding
+        return values
+
+    def apply_stack(self, env, n):
+        "Call the value with the top n values of the stack as arguments"
+        if n > len(self.stack):
+            self.thaw(n)
         try:
-            self.value.call(env, args if args else self.pop_args())
+            call = self.value.call_stack
         except AttributeError:
             self.error('not a function', data=self.value)
+        call(env, n)
+
+    def apply_function(self, env, args):
+        "Call the value with the list args"
+        try:
+            call = self.value.call
+        except AttributeError:
+            self.error('not a function', data=self.value)
+        call(env, args)
 
     def debug_last_ins(self, dbg):
         index = self.pc - 1
@@ -86,49 +205,178 @@ class ExecEnv:
         raise e
 
     def call(self, env, args):
-        "Call as continuation object"
+        "Call as continuation object. Runs a copy, so it can be called again"
         if len(args) != 1:
             env.exe.error('ExecEnv takes one argument')
-        self.value = args[0]
-        env.exe = self
+        exe = copy.copy(self)
+        exe.stack = []
+        exe.base_stack = []
+        exe.value = args[0]
+        env.exe = exe
+
+    def call_stack(self, env, n):
+        self.call(env, env.exe.pop_values(n))
 
     def sexpr(self):
         return '#exec_env'
 
+class Escape:
+    """Escape continuation made by call/ec. It can only be called until its
+    call/ec returns, which is all early exits need. So it is enough to save
+    the state of the ExecEnv, which is never changed but for the value
+    stack, and to cut that back to its height when called"""
+
+    def __init__(self, exe):
+        self.ins = exe.ins
+        self.pc = exe.pc
+        self.ins_pc_stack = exe.ins_pc_stack
+        self.local = exe.local
+        self.local_stack = exe.local_stack
+        self.stack = exe.stack
+        self.height = len(exe.stack)
+        self.frozen = exe.frozen
+        # Escape of the enclosing call/ec
+        self.outer = exe.escape
+        self.leave = instr.Instructions(data=[instr.Resume(self.resume, None)])
+
+    def resume(self, env, state):
+        "The call/ec returned"
+        env.exe.escape = self.outer
+
+    def call(self, env, args):
+        if len(args) != 1:
+            env.exe.error('escape continuation takes one argument')
+        exe = env.exe
+        escape = exe.escape
+        while escape is not self:
+            if escape is None:
+                exe.error('escape continuation called after its call/ec returned')
+            escape = escape.outer
+        exe.ins = self.ins
+        exe.pc = self.pc
+        exe.ins_pc_stack = self.ins_pc_stack
+        exe.local = self.local
+        exe.local_stack = self.local_stack
+        if exe.stack is self.stack:
+            del exe.stack[self.height:]
+        else:
+            # A continuation was captured since, which froze the stack
+            exe.stack = []
+            exe.frozen = (self.stack, self.height, self.frozen) if self.height else self.frozen
+        exe.escape = self.outer
+        exe.value = args[0]
+
+    def call_stack(self, env, n):
+        self.call(env, env.exe.pop_values(n))
+
+    def sexpr(self):
+        return '#escape'
+
+class Cell:
+    """A global variable. LoadGlobal and StoreGlobal keep the cell of
+    their variable once looked up, so later uses are no dict lookups"""
+    __slots__ = ('value', 'const')
+
+    def __init__(self, value, const):
+        # None if not defined yet
+        self.value = value
+        # Defined in glob_const, can not be set
+        self.const = const
+
 class Env:
     def __init__(self, dbg):
         self.exe = None
 
+        # Constants: builtins and global functions. Names defined once code
+        # has run must be added with define_global_function()
         self.glob_const = {}
-        self.glob = {}
+        # name -> Cell, of all globals used at runtime
+        self.cells = {}
         self.func_unknowns = {}
+        # Impure function -> {functions referring to it: None}, redone if it
+        # is upgraded, see resolve_function_unknowns()
+        self.func_callers = {}
         self.dbg = dbg
 
+        # function.Memo of pure function results, None to not memoise
+        self.memo = None
+
+        # Dispatch table: instruction class -> bound handler
+        self.ins_handlers = {
+            instr.Arg: self.exec_arg,
+            instr.Call: self.exec_call,
+            instr.CallCC: self.exec_call_cc,
+            instr.CallEC: self.exec_call_ec,
+            instr.DefineGlobalFunction: self.exec_define_global_function,
+            instr.If: self.exec_if,
+            instr.Load: self.exec_load,
+            instr.LoadGlobal: self.exec_load_global,
+            instr.LoadLiteral: self.exec_load_literal,
+            instr.LoadLocal: self.exec_load_local,
+            instr.LoadStack: self.exec_load_stack,
+            instr.LoadSkip: self.exec_load_skip,
+            instr.MakeClosure: self.exec_make_closure,
+            instr.MoveLocalRange: self.exec_move_local_range,
+            instr.MoveStackRange: self.exec_move_stack_range,
+            instr.PopLocals: self.exec_pop_locals,
+            instr.PopStack: self.exec_pop_stack,
+            instr.Resume: self.exec_resume,
+            instr.Store: self.exec_store,
+            instr.StoreGlobal: self.exec_store_global,
+            instr.StoreLocal: self.exec_store_local,
+            instr.StoreStack: self.exec_store_stack,
+            instr.StoreSkip: self.exec_store_skip,
+            instr.TailCall: self.exec_tail_call,
+        }
+
+    def cell(self, name):
+        "The Cell of global name, made on first use"
+        cell = self.cells.get(name, None)
+        if cell is None:
+            value = self.glob_const.get(name, None)
+            cell = self.cells[name] = Cell(value, value is not None)
+        return cell
+
     def lookup_unknown(self, sym):
-        try:
-            return self.glob_const[sym.symbol]
-        except KeyError:
-            try:
-                return self.glob[sym.symbol]
-            except KeyError:
-                self.exe.error('unknown variable', data=sym)
+        value = self.cell(sym.symbol).value
+        if value is None:
+            self.exe.error('unknown variable', data=sym)
+        return value
 
     def set_unknown(self, sym):
-        if sym.symbol in self.glob_const:
+        cell = self.cell(sym.symbol)
+        if cell.const:
             self.exe.error('cannot set constant', data=sym)
-        self.glob[sym.symbol] = self.exe.value
+        cell.value = self.exe.value
 
     def resolve_function_unknowns(self, caller, callee, symbol):
+        """symbol, unknown when caller was compiled, is now the function callee.
+        Redo the purity analysis of caller, which may upgrade it and the
+        functions it refers to, then that of the callers of any upgraded
+        function. Returns whether caller is pure"""
         self.dbg.eval.d('resolve_function_unknowns(', caller, ', ', callee, ', ', symbol, ')')
-        return False
+        work = [caller]
+        while work:
+            func = work.pop()
+            if func.is_pure():
+                continue
+            graph = optimize.PurityGraph(self)
+            graph.graph(func)
+            impure = [f for f in graph.funcs.values() if not f.is_pure()]
+            graph.solve()
+            for f in impure:
+                if f.is_pure():
+                    work.extend(self.func_callers.pop(f, ()))
+        return caller.is_pure()
 
     def resolve_unknowns(self, func, symbol, unknown_references):
         self.dbg.eval.d('resolve_unknowns, new function ', symbol, ' unknown: ', unknown_references)
-        if symbol in self.func_unknowns:
+        # Constants can not be redefined, so symbol is never unknown again
+        callers = self.func_unknowns.pop(symbol, None)
+        if callers:
             # Resolve all functions referring to the new one
-            for func2 in self.func_unknowns[symbol]:
-                if self.resolve_function_unknowns(func2, func, symbol):
-                    pass
+            for func2 in callers:
+                self.resolve_function_unknowns(func2, func, symbol)
 
         for unk in unknown_references:
             d = self.func_unknowns.get(unk, None)
@@ -141,6 +389,9 @@ class Env:
         if sym.symbol in self.glob_const:
             self.exe.error('cannot redefine constant', data=sym)
         self.glob_const[sym.symbol] = self.exe.value
+        cell = self.cell(sym.symbol)
+        cell.value = self.exe.value
+        cell.const = True
         self.resolve_unknowns(self.exe.value, sym.symbol, unknown_references)
 
     def lookup_const(self, sym):
@@ -151,7 +402,8 @@ class Env:
             self.exe.error('wrong number of arguments, should be ' + str(n))
 
     def eval_noexcept(self, ins, **kw):
-        self.exe = ExecEnv(ins)
+        "Evaluate ins. kw are passed to loop()"
+        self.exe = ExecEnv(instr.finalize(ins))
         try:
             self.loop(**kw)
         except StopIteration:
@@ -166,8 +418,110 @@ class Env:
             print(e)
             return self.exe.value
 
-    def loop(self):
+    def exec_call(self, i):
+        self.exe.apply_stack(self, i.nparams)
+
+    def exec_tail_call(self, i):
+        self.exe.tail = True
+        self.exe.apply_stack(self, i.nparams)
+        self.exe.tail = False
+
+    def exec_call_cc(self, i):
+        exe = self.exe
+        exe.freeze()
+        exe.apply_function(self, [copy.copy(exe)])
+
+    def exec_call_ec(self, i):
+        exe = self.exe
+        escape = Escape(exe)
+        exe.escape = escape
+        exe.push_ins(escape.leave)
+        exe.apply_function(self, [escape])
+
+    def exec_if(self, i):
+        self.exe.push_ins(i.true if cons.is_true(self.exe.value) else i.false)
+
+    def exec_load(self, i):
+        # Load instructions are replaced by instr.finalize() if resolvable
+        self.exe.error('unknown location for Load:', data=i.loc)
+
+    def exec_move_local_range(self, i):
+        self.exe.local.move_range(i.start, i.end, i.positions)
+
+    def exec_move_stack_range(self, i):
+        self.exe.move_stack_range(i.start, i.end, i.positions)
+
+    def exec_pop_locals(self, i):
+        self.exe.pop_local_stack()
+
+    def exec_pop_stack(self, i):
+        self.exe.pop_stack_frame()
+
+    def exec_resume(self, i):
+        i.callback(self, i.state)
+
+    def exec_store(self, i):
+        self.exe.error('cannot Store to location: ', data=i.loc)
+
+    def exec_arg(self, i):
+        self.exe.stack.append(self.exe.value)
+
+    def exec_load_literal(self, i):
+        self.exe.value = i.value
+
+    def exec_load_local(self, i):
+        self.exe.value = self.exe.local.mem[i.index]
+
+    def exec_load_stack(self, i):
+        exe = self.exe
+        exe.value = exe.stack[exe.base + i.index]
+
+    def exec_load_skip(self, i):
+        # Load from this or parent environment
+        self.exe.value = self.exe.local.display[i.skip][i.index]
+
+    def exec_make_closure(self, i):
+        # Function with inherited environment
+        self.exe.value = function.Closure(i.function, self.exe.local.skip(i.skip))
+
+    def exec_load_global(self, i):
+        cell = i.cell
+        if cell is None:
+            cell = i.cell = self.cell(i.sym.symbol)
+        value = cell.value
+        if value is None:
+            self.exe.error('unknown variable', data=i.sym)
+        self.exe.value = value
+
+    def exec_store_local(self, i):
+        self.exe.local.mem[i.index] = self.exe.value
+
+    def exec_store_stack(self, i):
+        exe = self.exe
+        exe.stack[exe.base + i.index] = exe.value
+
+    def exec_store_skip(self, i):
+        self.exe.local.display[i.skip][i.index] = self.exe.value
+
+    def exec_store_global(self, i):
+        cell = i.cell
+        if cell is None:
+            cell = i.cell = self.cell(i.sym.symbol)
+        if cell.const:
+            self.exe.error('cannot set constant', data=i.sym)
+        cell.value = self.exe.value
+
+    def exec_define_global_function(self, i):
+        self.define_global_function(i.sym, i.unknown_references)
+
+    def loop(self, max_steps=None):
+        """Execute instructions until StopIteration is raised at the end.
+        max_steps -- raise StepLimitError after executing this many instructions"""
+        if max_steps is not None:
+            return self.loop_limited(max_steps)
+
         dbg = self.dbg.eval
+        handlers = self.ins_handlers
 
         while True:
             i = self.exe.__next__()
@@ -175,62 +529,22 @@ class Env:
             if dbg.enabled:
                 self.exe.debug_last_ins(dbg)
 
-            if isinstance(i, instr.Call):
-                self.exe.apply_function(self)
-            elif isinstance(i, instr.CallCC):
-                self.exe.apply_function(self, [copy.copy(self.exe)])
-            elif isinstance(i, instr.If):
-                self.exe.push_ins(i.true if cons.is_true(self.exe.value) else i.false)
-            elif isinstance(i, instr.Load):
-                loc = i.loc
-
-                if isinstance(loc, instr.LiteralLocation):
-                    self.exe.value = loc.value
-                elif isinstance(loc, instr.LocalLocation):
-                    self.exe.value = self.exe.local.lookup(loc.index, 0)
-                elif isinstance(loc, instr.EnvSkipLocation):
-                    next = loc.loc
-                    if isinstance(next, instr.LocalLocation):
-                        # Load from this or parent environment
-                        self.exe.value = self.exe.local.lookup(next.index, loc.skip)
-                    elif isinstance(next, function.Function):
-                        # Function with inherited environment
-                        # debug.d('load skip func!!!', loc)
-                        self.exe.value = function.Closure(next, self.exe.local.skip(loc.skip))
-                    else:
-                        self.exe.error('cannot skip', data=target)
-                elif isinstance(loc, instr.UnknownLocation):
-                    self.exe.value = self.lookup_unknown(loc.sym)
-                elif isinstance(loc, function.Function):
-                    # Function with no inherited environment
-                    self.exe.value = loc
-                else:
-                    self.exe.error('unknown location for Load:', data=loc)
-            elif isinstance(i, instr.MoveLocalRange):
-                self.exe.local.move_range(i.start, i.end, i.positions)
-            elif isinstance(i, instr.PopLocals):
-                self.exe.local = self.exe.local_stack.pop()
-            elif isinstance(i, instr.PushArgs):
-                self.exe.args_stack.append(self.exe.args)
-                self.exe.args = []
-            elif isinstance(i, instr.Store):
-                loc = i.loc
-
-                if isinstance(loc, instr.LocalLocation):
-                    self.exe.local.assign(loc.index, 0, self.exe.value)
-                elif isinstance(loc, instr.EnvSkipLocation):
-                    self.exe.local.assign(loc.loc.index, loc.skip, self.exe.value)
-                elif isinstance(loc, instr.UnknownLocation):
-                    self.set_unknown(loc.sym)
-                elif isinstance(loc, instr.GlobalFunctionLocation):
-                    self.define_global_function(loc.sym, loc.unknown_references)
-                else:
-                    self.exe.error('cannot Store to location: ', data=loc)
-            elif isinstance(i, instr.Arg):
-                self.exe.args.append(self.exe.value)
-            elif isinstance(i, instr.ArgPrepend):
-                self.exe.args = [self.exe.value] + self.exe.args
-            else:
-                self.exe.error('cannot execute instruction: ', i)
+            try:
+                handler = handlers[i.__class__]
+            except KeyError:
+                self.exe.error('cannot execute instruction: ', data=i)
+            handler(i)
+
+            if dbg.enabled:
+                dbg.d('=> ', str(self.exe.value))
 
-            dbg.d('=> ', str(self.exe.value))
+    def loop_limited(self, max_steps):
+        handlers = self.ins_handlers
+        for step in range(max_steps):
+            i = self.exe.__next__()
+            try:
+                handler = handlers[i.__class__]
+            except KeyError:
+                self.exe.error('cannot execute instruction: ', data=i)
+            handler(i)
+        raise StepLimitError('step limit reached: ' + str(max_steps))
@@ -1,44 +1,48 @@
 
 import cons
-import cons_util
 import debug
+import error
 import instr
 
+import collections
+
 class Base(cons.Base):
     def debug_post(self, env, args):
         print(self.sexpr(), [x.sexpr() for x in args], ' => ', env.exe.value.sexpr())
 
+    def call_stack(self, env, n):
+        "Call with the top n values of the value stack of env.exe as arguments"
+        self.call(env, env.exe.pop_values(n))
+
     def sexpr(self):
         return '#function.' + type(self).__name__
 
 class Locals:
-    'local environment for Function'
-    def __init__(self, size, parent):
-        self.mem = [None]*size
+    """local environment for Function
+    display -- mem lists of this and all ancestor frames, indexed by skip level
+    parents -- ancestor Locals, parents[n-1] is the frame n levels up"""
+    __slots__ = ('mem', 'parent', 'display', 'parents')
+
+    def __init__(self, size, parent, mem=None):
+        self.mem = [None]*size if mem is None else mem
         self.parent = parent
+        if parent:
+            self.display = (self.mem,) + parent.display
+            self.parents = (parent,) + parent.parents
+        else:
+            self.display = (self.mem,)
+            self.parents = ()
 
     def depth(self):
-        l = self
-        d = 0
-        while l:
-            d += 1
-            l = l.parent
-        return d
+        return len(self.display)
 
     def skip(self, n):
-        l = self
-        while l:
-            if n == 0:
-                return l
-            else:
-                l = l.parent
-                n -= 1
+        if n == 0:
+            return self
+        elif n <= len(self.parents):
+            return self.parents[n-1]
         return None
 
-    def apply_args(self, args):
-        for i, arg in enumerate(args):
-            self.mem[i] = arg
-
     def move_range(self, start, end, positions):
         #debug.d('pre move range: ', self.mem)
         items = self.mem[start:end]
@@ -47,21 +51,17 @@ class Locals:
         #debug.d('post move range: ', self.mem)
 
     def lookup(self, index, level):
-        if level == 0:
-            return self.mem[index]
-        else:
-            return self.parent.lookup(index, level-1)
+        return self.display[level][index]
 
     def assign(self, index, level, value):
-        if level == 0:
-            self.mem[index] = value
-        else:
-            self.parent.assign(index, level-1, value)
+        self.display[level][index] = value
 
     def __repr__(self):
         return 'local: [' + ','.join([str(x) for x in self.mem]) + ']'
 
-# Purity levels
+# Purity levels. Set by the compiler from the variables a function refers
+# to, then by optimize.PurityGraph from what it calls: a function is only
+# left PURE if it has no side effects and all functions it calls are pure
 PURITY_LEVEL_DEEP_ENV = 0 # lowest level
 PURITY_LEVEL_SHALLOW_ENV = 1 # env level == 1
 PURITY_LEVEL_PURE = 2
@@ -71,11 +71,16 @@ class Function(Base, instr.BaseLocation):
 
     def __init__(self):
         self.ins = None
+        self.code = None
         self.nargs = 0
         self.size = 0
         self.dotted = False
         self.purity_level = PURITY_LEVEL_PURE
         self.tag = None
+        # Whether code keeps locals on the value stack, see get_code()
+        self.frameless = False
+        # Initial values of the locals after the arguments
+        self.padding = ()
 
     def __str__(self):
         label = 'Function(%d|%d' % (self.nargs, self.size)
@@ -102,6 +107,34 @@ class Function(Base, instr.BaseLocation):
     def get_ins(self):
         return [self.ins]
 
+    def __getstate__(self):
+        # Finalized code is rebuilt after loading from the compile cache
+        state = self.__dict__.copy()
+        state['code'] = None
+        return state
+
+    def get_code(self):
+        """Finalized instructions, see instr.finalize(). Computed on first call.
+        Pure functions not needing a Locals frame are made frameless: nothing
+        they call can capture a continuation, so their locals can be dropped
+        from the value stack on return"""
+        if self.code is None:
+            code = instr.finalize(self.ins)
+            self.frameless = self.is_pure() and not instr.needs_frame(code)
+            if self.frameless:
+                code = instr.frameless(code)
+            self.padding = (None,) * (self.size - self.nargs)
+            self.code = code
+        return self.code
+
+    def load_ins(self):
+        # Function with no inherited environment
+        return instr.LoadLiteral(self)
+
+    def skip_load_ins(self, skip):
+        # Function with inherited environment
+        return instr.MakeClosure(self, skip)
+
     def sexpr(self):
         return '#' + str(self)
 
@@ -114,15 +147,97 @@ class Function(Base, instr.BaseLocation):
         else:
             env.assert_arglen(args, n)
 
-        # Assign local memory to the function
-        l = Locals(self.size, inh_local)
-        l.apply_args(args)
-        # TODO: A function containing no lambdas can just extend
-        # the current local? BUT What about continuations then?
-        env.exe.push_local_autopop(l)
+        memo = env.memo
+        if memo is not None and self.purity_level == PURITY_LEVEL_PURE:
+            key = memo.key(self, args)
+            if key is not None:
+                value = memo.lookup(key)
+                if value is not None:
+                    env.exe.value = value
+                    return
+                if not env.exe.tail:
+                    # The result is stored when the body returns. Tail calls
+                    # return to a caller that stores the same value
+                    env.exe.push_ins(memo.store_ins(key))
+
+        env.exe.stack += args
+        self.enter(env, n, inh_local)
+
+    def call_stack(self, env, n, inh_local=None):
+        if n != self.nargs or self.dotted or (env.memo is not None and self.is_pure()):
+            self.call(env, env.exe.pop_values(n), inh_local)
+            return
+        self.enter(env, n, inh_local)
+
+    def enter(self, env, n, inh_local):
+        "Enter the body with the n arguments on top of the value stack"
+        code = self.get_code()
+        exe = env.exe
+        if self.frameless:
+            exe.push_stack_frame(n, self.padding, code)
+        else:
+            # Assign local memory to the function
+            exe.push_frame(Locals(self.size, inh_local, exe.pop_values(n, self.padding)), code)
+        exe.value = cons.VOID
+
+class Memo:
+    """Bounded LRU cache of the results of pure Function calls, see
+    Function.call(). Calls are cached if all arguments are numbers,
+    strings or symbols. Results that are lists, vectors, hash tables or
+    functions are not cached, since each call returns a new one"""
+
+    def __init__(self, size):
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, func, args):
+        "Key for calling func with args, None if the call can not be cached"
+        key = [func]
+        for arg in args:
+            cls = arg.__class__
+            if cls is cons.Number:
+                # 1 and 1.0 are equal, but may give different results
+                n = arg.number
+                key.append((n.__class__, n))
+            elif cls is cons.String:
+                key.append(arg.string)
+            elif cls is cons.Symbol or cls is cons.Null or cls is cons.Void:
+                # Interned
+                key.append(arg)
+            else:
+                return None
+        return tuple(key)
+
+    def lookup(self, key):
+        value = self.results.get(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+        return value
+
+    def store_ins(self, key):
+        return instr.Instructions(data=[instr.Resume(self.resume, key)])
+
+    def resume(self, env, key):
+        value = env.exe.value
+        if isinstance(value, (cons.Pair, cons.Vector, cons.HashTable, Base)):
+            return
+        self.results[key] = value
+        if len(self.results) > self.size:
+            self.results.popitem(last=False)
+
+    def clear(self):
+        self.results.clear()
+        self.hits = 0
+        self.misses = 0
 
-        env.exe.push_ins(self.ins)
-        env.exe.value = cons.Void()
+    def __str__(self):
+        return 'memo: %d hits, %d misses, %d/%d entries' % (
+            self.hits, self.misses, len(self.results), self.size)
 
 class Closure(Base):
     'Instantiated first class function, with inherited environment'
@@ -134,13 +249,70 @@ class Closure(Base):
     def call(self, env, args):
         self.function.call(env, args, self.inh_local)
 
+    def call_stack(self, env, n):
+        self.function.call_stack(env, n, self.inh_local)
+
 class Apply(Base):
+    'apply: (apply fn arg ... lst)'
     def call(self, env, args):
-        env.assert_arglen(args, 2)
+        if len(args) < 2:
+            env.exe.error('wrong number of arguments, should be at least 2')
+        pyargs = args[1:-1]
+        p = args[-1]
+        while isinstance(p, cons.Pair):
+            pyargs.append(p.car)
+            p = p.cdr
+        if not isinstance(p, cons.Null):
+            env.exe.error('apply: last argument is not a list', data=args[-1])
         env.exe.value = args[0]
-        pyargs = [x for x in cons_util.traverse_list(args[1])]
         env.exe.apply_function(env, args=pyargs)
 
+class Map(Base):
+    """map over one or more lists, stopping at the shortest.
+    Each callback result is consed onto an accumulator which is kept in a
+    fresh Resume instruction per step, so a continuation captured inside the
+    callback can be re-entered any number of times."""
+
+    def call(self, env, args):
+        if len(args) < 2:
+            env.exe.error('wrong number of arguments, should be at least 2')
+        self.next(env, args[0], args[1:], cons.NULL)
+
+    def next(self, env, fn, lsts, acc):
+        cars = []
+        cdrs = []
+        for p in lsts:
+            if not isinstance(p, cons.Pair):
+                env.exe.value = self.done(acc)
+                return
+            cars.append(p.car)
+            cdrs.append(p.cdr)
+
+        env.exe.push_ins(instr.Instructions(data=[instr.Resume(self.resume, (fn, cdrs, acc))]))
+        env.exe.value = fn
+        env.exe.apply_function(env, args=cars)
+
+    def resume(self, env, state):
+        fn, lsts, acc = state
+        self.next(env, fn, lsts, cons.Pair(env.exe.value, acc))
+
+    def done(self, acc):
+        result = cons.NULL
+        while isinstance(acc, cons.Pair):
+            result = cons.Pair(acc.car, result)
+            acc = acc.cdr
+        return result
+
+class ForEach(Map):
+    'for-each over one or more lists, stopping at the shortest'
+
+    def resume(self, env, state):
+        fn, lsts, acc = state
+        self.next(env, fn, lsts, acc)
+
+    def done(self, acc):
+        return cons.VOID
+
 class Generic(Base):
     def __init__(self, name, func, pure):
         self.name = name
@@ -178,6 +350,19 @@ class PyOp(Base):
             #print('called py_function: ' + str(self.py_func) + ','.join([str(x) for x in py_args]) + ' result: ' + str(result))
             env.exe.value = cons.from_py(result)
 
+    def call_stack(self, env, n):
+        # Fold the arguments where they are on the value stack
+        if n == 0:
+            env.exe.error('no arguments')
+        stack = env.exe.stack
+        start = len(stack) - n
+        py_func = self.py_func
+        result = cons.to_py(stack[start])
+        for k in range(start + 1, start + n):
+            result = py_func(result, cons.to_py(stack[k]))
+        del stack[start:]
+        env.exe.value = cons.from_py(result)
+
     def is_pure(self):
         return True
 
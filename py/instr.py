@@ -7,19 +7,37 @@ import debug
 #
 
 class BaseLocation:
+    __slots__ = ()
+
     def get_ins(self):
         return []
 
     def hvtree(self):
         return ([self], [])
 
+    def load_ins(self):
+        'Specialised instruction loading from this location, None if unknown'
+        return None
+
+    def store_ins(self):
+        'Specialised instruction storing to this location, None if unknown'
+        return None
+
+    def skip_load_ins(self, skip):
+        return None
+
 class LiteralLocation(BaseLocation):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
     def __str__(self):
         return 'Literal(' + self.value.sexpr() + ')'
 
+    def load_ins(self):
+        return LoadLiteral(self.value)
+
     def hvtree(self):
         if getattr(self.value, 'tree', None):
             h, v = self.value.hvtree()
@@ -28,13 +46,26 @@ class LiteralLocation(BaseLocation):
             return ([self], [])
 
 class LocalLocation(BaseLocation):
+    __slots__ = ('index',)
+
     def __init__(self, index):
         self.index = index
 
     def __str__(self):
         return 'Local(' + str(self.index) + ')'
 
+    def load_ins(self):
+        return LoadLocal(self.index)
+
+    def store_ins(self):
+        return StoreLocal(self.index)
+
+    def skip_load_ins(self, skip):
+        return LoadSkip(self.index, skip)
+
 class EnvSkipLocation(BaseLocation):
+    __slots__ = ('loc', 'skip')
+
     def __init__(self, loc, skip):
         self.loc = loc
         self.skip = skip
@@ -42,18 +73,36 @@ class EnvSkipLocation(BaseLocation):
     def __str__(self):
         return 'Skip(' + str(self.skip) + ')'
 
+    def load_ins(self):
+        return self.loc.skip_load_ins(self.skip)
+
+    def store_ins(self):
+        if isinstance(self.loc, LocalLocation):
+            return StoreSkip(self.loc.index, self.skip)
+        return None
+
     def hvtree(self):
         h, v = self.loc.hvtree()
         return ([self] + h, v)
 
 class UnknownLocation(BaseLocation):
+    __slots__ = ('sym',)
+
     def __init__(self, sym):
         self.sym = sym
 
     def __str__(self):
         return 'Unknown(' + self.sym.sexpr() + ')'
 
+    def load_ins(self):
+        return LoadGlobal(self.sym)
+
+    def store_ins(self):
+        return StoreGlobal(self.sym)
+
 class GlobalFunctionLocation(BaseLocation):
+    __slots__ = ('sym', 'unknown_references')
+
     def __init__(self, sym, unknown_references):
         self.sym = sym
         self.unknown_references = unknown_references
@@ -61,11 +110,16 @@ class GlobalFunctionLocation(BaseLocation):
     def __str__(self):
         return 'GlobalFunction(' + self.sym.sexpr() + ')'
 
+    def store_ins(self):
+        return DefineGlobalFunction(self.sym, self.unknown_references)
+
 #
 # High level instruction definition
 #
 
 class BaseInstr:
+    __slots__ = ()
+
     def dump(self, guard, level):
         idump(self, guard, level)
 
@@ -75,24 +129,41 @@ class BaseInstr:
     def get_ins(self):
         return []
 
+    def finalize(self):
+        'Return the specialised form of this instruction, None to drop it'
+        return self
+
     def __str__(self):
         return self.__class__.__name__
 
 class Arg(BaseInstr):
-    'Append arg'
-
-class ArgPrepend(BaseInstr):
-    'Prepend arg'
+    'Push the value as an argument on the value stack of ExecEnv'
+    __slots__ = ()
 
 class Call(BaseInstr):
+    'Call the value with the top nparams values of the value stack'
+    __slots__ = ('nparams',)
+
     def __init__(self, nparams):
-        # Ignored for now. Arg instruction is the current argument counter
-        pass
+        self.nparams = nparams
+
+    def __str__(self):
+        return '%s(%d)' % (self.__class__.__name__, self.nparams)
+
+class TailCall(Call):
+    'Call in tail position of a function body, replaces the current frame'
+    __slots__ = ()
 
 class CallCC(BaseInstr):
-    pass
+    __slots__ = ()
+
+class CallEC(BaseInstr):
+    'call/ec: call the value with an escape continuation, see eval.Escape'
+    __slots__ = ()
 
 class If(BaseInstr):
+    __slots__ = ('true', 'false')
+
     def __init__(self, true, false):
         self.true = true
         self.false = false
@@ -103,7 +174,12 @@ class If(BaseInstr):
     def get_ins(self):
         return [self.true, self.false]
 
+    def finalize(self):
+        return If(finalize(self.true), finalize(self.false))
+
 class Load(BaseInstr):
+    __slots__ = ('loc',)
+
     def __init__(self, loc):
         self.loc = loc
 
@@ -114,22 +190,46 @@ class Load(BaseInstr):
     def get_ins(self):
         return self.loc.get_ins()
 
+    def finalize(self):
+        return self.loc.load_ins() or self
+
 class MoveLocalRange(BaseInstr):
+    __slots__ = ('start', 'end', 'positions')
+
     def __init__(self, start, end, positions):
         self.start = start
         self.end = end
         self.positions = positions
 
     def __str__(self):
-        return 'MoveLocalRange([%d:%d] %s%d)' % (self.start, self.end, '+' if self.positions > 0 else '', self.positions)
+        return '%s([%d:%d] %s%d)' % (self.__class__.__name__, self.start, self.end,
+                                     '+' if self.positions > 0 else '', self.positions)
 
 class PopLocals(BaseInstr):
-    pass
+    __slots__ = ()
+
+class PopStack(BaseInstr):
+    'Leave the frame of a frameless function'
+    __slots__ = ()
+
+class Resume(BaseInstr):
+    'Continue a native function with its state once a call it made returns'
+    __slots__ = ('callback', 'state')
+
+    def __init__(self, callback, state):
+        self.callback = callback
+        self.state = state
 
 class PushArgs(BaseInstr):
-    pass
+    'Start of a call, for optimize.CallOptimizer. Dropped by finalize()'
+    __slots__ = ()
+
+    def finalize(self):
+        return None
 
 class Store(BaseInstr):
+    __slots__ = ('loc',)
+
     def __init__(self, loc):
         self.loc = loc
 
@@ -140,7 +240,129 @@ class Store(BaseInstr):
     def get_ins(self):
         return self.loc.get_ins()
 
+    def finalize(self):
+        return self.loc.store_ins() or self
+
+#
+# Specialised instructions, produced from Load/Store by finalize()
+#
+
+class LoadLiteral(BaseInstr):
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return 'LoadLiteral(' + self.value.sexpr() + ')'
+
+class LoadLocal(BaseInstr):
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __str__(self):
+        return 'LoadLocal(%d)' % self.index
+
+class LoadSkip(BaseInstr):
+    __slots__ = ('index', 'skip')
+
+    def __init__(self, index, skip):
+        self.index = index
+        self.skip = skip
+
+    def __str__(self):
+        return 'LoadSkip(%d, skip=%d)' % (self.index, self.skip)
+
+class MakeClosure(BaseInstr):
+    __slots__ = ('function', 'skip')
+
+    def __init__(self, function, skip):
+        self.function = function
+        self.skip = skip
+
+    def hvtree(self):
+        return ([self], [self.function])
+
+    def __str__(self):
+        return 'MakeClosure(skip=%d)' % self.skip
+
+class LoadStack(BaseInstr):
+    'Load a local of a frameless function, see frameless()'
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __str__(self):
+        return 'LoadStack(%d)' % self.index
+
+class LoadGlobal(BaseInstr):
+    'Load a global unknown at compile time. cell is bound on first use, see eval.Cell'
+    __slots__ = ('sym', 'cell')
+
+    def __init__(self, sym):
+        self.sym = sym
+        self.cell = None
+
+    def __str__(self):
+        return 'LoadGlobal(' + self.sym.sexpr() + ')'
+
+class StoreLocal(BaseInstr):
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __str__(self):
+        return 'StoreLocal(%d)' % self.index
+
+class StoreSkip(BaseInstr):
+    __slots__ = ('index', 'skip')
+
+    def __init__(self, index, skip):
+        self.index = index
+        self.skip = skip
+
+    def __str__(self):
+        return 'StoreSkip(%d, skip=%d)' % (self.index, self.skip)
+
+class StoreStack(BaseInstr):
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __str__(self):
+        return 'StoreStack(%d)' % self.index
+
+class MoveStackRange(MoveLocalRange):
+    __slots__ = ()
+
+class StoreGlobal(BaseInstr):
+    __slots__ = ('sym', 'cell')
+
+    def __init__(self, sym):
+        self.sym = sym
+        self.cell = None
+
+    def __str__(self):
+        return 'StoreGlobal(' + self.sym.sexpr() + ')'
+
+class DefineGlobalFunction(BaseInstr):
+    __slots__ = ('sym', 'unknown_references')
+
+    def __init__(self, sym, unknown_references):
+        self.sym = sym
+        self.unknown_references = unknown_references
+
+    def __str__(self):
+        return 'DefineGlobalFunction(' + self.sym.sexpr() + ')'
+
 class Instructions(list):
+    __slots__ = ('tags',)
+
     def __init__(self, debuggable=False, data=None):
         if debuggable:
             self.tags = []
@@ -162,6 +384,15 @@ class Instructions(list):
         if hasattr(self, 'tags'):
             self.tags[index:index] = [None]
 
+    def replace_ins(self, start, end, ins, tags=None):
+        """Replace self[start:end] with ins, keeping tags aligned.
+        tags -- tags of ins, by default the tags ins has if any"""
+        self[start:end] = ins
+        if hasattr(self, 'tags'):
+            if tags is None:
+                tags = getattr(ins, 'tags', None) or [None] * len(ins)
+            self.tags[start:end] = tags
+
     def append_with_tag(self, i, tag):
         self.append(i)
         self.tags.append(tag)
@@ -171,3 +402,50 @@ class Instructions(list):
 
     def __str__(self):
         return 'instr(' + str(len(self)) + ')'
+
+def finalize(ins):
+    """Translate generic Load/Store instructions into specialised ones.
+    Returns new Instructions with the same tags. Function bodies are
+    finalized lazily, see function.Function.get_code()"""
+    if not ins:
+        return ins
+    data = [i.finalize() for i in ins]
+    code = Instructions(data=[i for i in data if i is not None])
+    if hasattr(ins, 'tags'):
+        code.tags = [tag for (i, tag) in zip(data, ins.tags) if i is not None]
+    return code
+
+def needs_frame(code):
+    """Whether finalized code needs a Locals frame: it creates closures,
+    uses enclosing frames or captures continuations"""
+    for i in code or ():
+        cls = i.__class__
+        if (cls is MakeClosure or cls is LoadSkip or cls is StoreSkip or
+            cls is CallCC or cls is CallEC):
+            return True
+        elif cls is If and (needs_frame(i.true) or needs_frame(i.false)):
+            return True
+    return False
+
+def frameless(code):
+    """Translate finalized code to keep its locals on the value stack of
+    ExecEnv instead of in Locals, see ExecEnv.push_stack_frame().
+    Only for code that does not need_frame()"""
+    if not code:
+        return code
+    data = []
+    for i in code:
+        cls = i.__class__
+        if cls is LoadLocal:
+            i = LoadStack(i.index)
+        elif cls is StoreLocal:
+            i = StoreStack(i.index)
+        elif cls is MoveLocalRange:
+            i = MoveStackRange(i.start, i.end, i.positions)
+        elif cls is If:
+            i = If(frameless(i.true), frameless(i.false))
+        data.append(i)
+    result = Instructions(data=data)
+    if hasattr(code, 'tags'):
+        result.tags = list(code.tags)
+    return result
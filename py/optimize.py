@@ -1,54 +1,221 @@
 
 import comp
+import cons
 import debug
+import error
+import function
 import instr
 
 class PurityGraph:
-    def __init__(self, env):
+    """
+    Interprocedural purity analysis. A function is pure if calling it has
+    no side effects and its result depends only on its arguments, or for
+    closures also on the environment closed over. That holds if the
+    function does nothing impure by itself and every function it refers
+    to is pure. Recursion is handled by solving for the greatest fixpoint:
+    all functions start out pure, and those referring to something impure
+    are removed until nothing changes.
+
+    Impure by itself is referring to a global variable or a builtin with
+    side effects, storing to a global, calling something not known at
+    compile time, or capturing a continuation.
+    Functions are found by walking hvtree(). Global names unknown at
+    compile time are looked up in env, see Env.resolve_function_unknowns()
+    """
+
+    def __init__(self, env, settled=None):
         self.env = env
-        self.object_index_alloc = 0
-        self.object_index = 0
-        self.reg = {}
+        # Functions whose purity_level is final, by id
+        self.settled = settled if settled is not None else {}
+        # Functions being analysed, by id
+        self.funcs = {}
+        # id -> {id of referred function: None}
+        self.refs = {}
+        # id -> None for functions impure by themselves
+        self.impure = {}
+
+    def graph(self, what):
+        "Add the functions reachable from instructions or a function"
+        pending = []
+        if isinstance(what, function.Function):
+            self.refer(None, what, pending)
+        else:
+            self.walk(what, None, pending)
+        while pending:
+            func = pending.pop()
+            self.walk(func.ins, func, pending)
+
+    def set_impure(self, owner):
+        if owner is not None:
+            self.impure[id(owner)] = None
+
+    def refer(self, owner, value, pending):
+        "owner refers to the constant value"
+        if isinstance(value, function.Function):
+            if id(value) in self.settled:
+                if not value.is_pure():
+                    self.set_impure(owner)
+                    self.add_caller(value, owner)
+                return
+            if id(value) not in self.funcs:
+                self.funcs[id(value)] = value
+                self.refs[id(value)] = {}
+                pending.append(value)
+            if owner is not None:
+                self.refs[id(owner)][id(value)] = None
+        elif isinstance(value, function.Base):
+            if not (hasattr(value, 'is_pure') and value.is_pure()):
+                self.set_impure(owner)
+
+    def add_caller(self, func, owner):
+        "Record that owner refers to the impure func, see Env.func_callers"
+        if owner is not None:
+            self.env.func_callers.setdefault(func, {})[owner] = None
+
+    def callee(self, i):
+        "The value called by a Call following i, None if unknown at compile time"
+        if not isinstance(i, instr.Load):
+            return None
+        loc = i.loc
+        if isinstance(loc, instr.EnvSkipLocation):
+            loc = loc.loc
+        if isinstance(loc, function.Function):
+            return loc
+        elif isinstance(loc, instr.LiteralLocation):
+            return loc.value
+        elif isinstance(loc, instr.UnknownLocation):
+            return self.env.lookup_const(loc.sym)
+        return None
+
+    def walk(self, ins, owner, pending):
+        "Walk the code of owner, not entering the functions it refers to"
+        stack = [ins]
+        while stack:
+            ins = stack.pop()
+            if not ins:
+                continue
+            prev = None
+            for i in ins:
+                if isinstance(i, instr.Call):
+                    if self.callee(prev) is None:
+                        self.set_impure(owner)
+                elif isinstance(i, (instr.CallCC, instr.CallEC)):
+                    self.set_impure(owner)
+
+                h, v = i.hvtree()
+                for obj in h[1:]:
+                    if isinstance(obj, function.Function):
+                        self.refer(owner, obj, pending)
+                        # Its code is walked as its own owner
+                        v = []
+                        break
+                    elif isinstance(obj, instr.LiteralLocation):
+                        self.refer(owner, obj.value, pending)
+                    elif isinstance(obj, instr.UnknownLocation):
+                        value = self.env.lookup_const(obj.sym)
+                        if value is None or isinstance(i, instr.Store):
+                            self.set_impure(owner)
+                        else:
+                            self.refer(owner, value, pending)
+                stack.extend(v)
+                prev = i
+
+    def solve(self):
+        """Find the greatest fixpoint and set purity_level of the functions
+        analysed: a pure function depending on the global environment is
+        upgraded to PURITY_LEVEL_PURE, an impure one claiming to be pure is
+        downgraded to PURITY_LEVEL_SHALLOW_ENV. Closures keep their level.
+        Returns the ids of the pure functions"""
+        callers = {}
+        for k, refs in self.refs.items():
+            for r in refs:
+                callers.setdefault(r, []).append(k)
 
-    def reg_pure(self, func):
-        pass
-    def push_func(self, func):
-        pass
-
-    def draw(self, what):
-        h, v = what.hvtree()
-        for obj in h:
-            if isinstance(obj, instr.Function):
-                if obj.purity_level == instr.PURITY_LEVEL_PURE:
-                    self.reg_pure(obj)
-                elif obj.purity_level == instr.PURITY_LEVEL_SHALLOW_ENV:
-                    self.push_func(obj)
-                    for child in v:
-                        self.draw(child)
-                    self.pop_func(obj)
-                else:
-                    # Can stop searching....
-                    self.reg_nonpure()
+        pure = dict.fromkeys(self.funcs)
+        work = list(self.impure)
+        while work:
+            k = work.pop()
+            if k in pure:
+                del pure[k]
+                work.extend(callers.get(k, ()))
+
+        for k, func in self.funcs.items():
+            if k in pure:
+                if func.purity_level == function.PURITY_LEVEL_SHALLOW_ENV:
+                    func.purity_level = function.PURITY_LEVEL_PURE
+            elif func.purity_level == function.PURITY_LEVEL_PURE:
+                func.purity_level = function.PURITY_LEVEL_SHALLOW_ENV
+            if not func.is_pure():
+                for c in callers.get(k, ()):
+                    self.add_caller(func, self.funcs[c])
+            self.settled[k] = func
+        return pure
 
 class PurityOptimizer:
     """
-    Optimize individual function defines that are potentially pure.
-    Purity can be a recursive definition.
+    Run the purity analysis on each compiled form. Functions analysed by
+    earlier forms are settled and not walked again.
     """
 
     def __init__(self, env, verbose=False):
         self.env = env
+        self.verbose = verbose
+        self.settled = {}
 
     def run(self, ins):
-        graph = PurityGraph(self.env)
+        graph = PurityGraph(self.env, self.settled)
         graph.graph(ins)
+        graph.solve()
+        if self.verbose:
+            for func in graph.funcs.values():
+                debug.d('purity ', str(func))
+        return ins
+
+    def compile_global(self, ins):
+        return self.run(ins)
+
+# Instructions a folded call may execute before it is left to runtime
+FOLD_MAX_STEPS = 10000
+
+def foldable(callee):
+    """Whether calls to callee with constant arguments can be evaluated at
+    compile time: pure builtins, and functions found pure by PurityGraph"""
+    return (isinstance(callee, (function.Generic, function.PyOp, function.Function)) and
+            callee.is_pure())
 
 class CallOptimizer:
+    """
+    Constant folding. Calls to pure functions whose arguments are all
+    constant, after folding nested calls, are evaluated at compile time
+    and replaced with a Load of the result. If instructions testing a
+    constant are replaced by the branch taken.
+    Needs PurityOptimizer to have run first.
+    """
+
     def __init__(self, env, verbose=False):
         self.env = env
         self.verbose = verbose
         self.pure_const_calls = []
         self.reg = {}
+        # Functions whose bodies are optimized
+        self.funcs = {}
+
+    def fold(self, ins, start, end):
+        "Evaluate ins[start:end], returning the value or None if it can not be folded"
+        saved = self.env.exe
+        try:
+            value = self.env.eval_noexcept(instr.Instructions(data=ins[start:end]),
+                                           max_steps=FOLD_MAX_STEPS)
+        except (error.Error, Exception):
+            # Leave the error, or a call taking too long, to runtime
+            return None
+        finally:
+            self.env.exe = saved
+        # Pairs, vectors, tables and closures are not shared between calls,
+        # keep allocating them
+        if isinstance(value, (cons.Pair, cons.Vector, cons.HashTable, function.Base)):
+            return None
+        return value
 
     def optimize_call(self, ins, index):
         start_index = index
@@ -58,7 +225,7 @@ class CallOptimizer:
         const_args = []
         while index < len(ins):
             i = ins[index]
-            if isinstance(i, instr.Arg) or isinstance(i, instr.ArgPrepend):
+            if isinstance(i, instr.Arg):
                 if isinstance(const_args, list):
                     if index - last == 1:
                         constant = comp.get_load_literal(ins[last])
@@ -71,23 +238,48 @@ class CallOptimizer:
                 index += 1
                 last = index
             elif isinstance(i, instr.Call):
-                if const_args and index - last == 1:
+                if isinstance(const_args, list) and index - last == 1:
                     constant = comp.get_load_literal(ins[last])
-                    if constant and constant.is_pure():
-                        value = self.env.eval(ins[start_index:index+1])
-                        ins[start_index:index+1] = [instr.Load(instr.LiteralLocation(value))]
-                        self.pure_const_calls.append((constant, const_args))
-                        return start_index + 1
+                    if constant and foldable(constant):
+                        value = self.fold(ins, start_index, index + 1)
+                        if value is not None:
+                            tag = ins.tags[start_index] if hasattr(ins, 'tags') else None
+                            ins.replace_ins(start_index, index + 1,
+                                            [instr.Load(instr.LiteralLocation(value))], [tag])
+                            self.pure_const_calls.append((constant, const_args))
+                            return start_index + 1
                 return index + 1
             else:
                 index = self.optimize_one(ins, index)
         raise error.Error("call not ended")
 
+    def optimize_if(self, ins, index):
+        "Replace an If testing a constant with the branch taken"
+        i = ins[index]
+        constant = comp.get_load_literal(ins[index - 1]) if index > 0 else None
+        if not constant:
+            return None
+        branch = i.true if cons.is_true(constant) else i.false
+        if branch is None:
+            # The test value is the result
+            ins.replace_ins(index, index + 1, [])
+            return index
+        # Continue with the inlined branch
+        ins.replace_ins(index - 1, index + 1, branch)
+        return index - 1
+
     def optimize_one(self, ins, index):
-        if isinstance(ins[index], instr.PushArgs):
+        i = ins[index]
+        if isinstance(i, instr.PushArgs):
             return self.optimize_call(ins, index)
+        elif isinstance(i, instr.If):
+            next_index = self.optimize_if(ins, index)
+            if next_index is not None:
+                return next_index
 
-        for sub_ins in ins[index].get_ins():
+        if isinstance(i, instr.Load) and isinstance(i.loc, function.Function):
+            self.funcs[id(i.loc)] = i.loc
+        for sub_ins in i.get_ins():
             if id(sub_ins) in self.reg:
                 continue
             self.reg[id(sub_ins)] = None
@@ -96,7 +288,7 @@ class CallOptimizer:
 
     def optimize_ins(self, ins, index):
         if not ins:
-            return 0
+            return ins
 
         index = 0
         while index < len(ins):
@@ -104,8 +296,17 @@ class CallOptimizer:
         return ins
 
     def run(self, ins):
+        self.reg = {}
+        self.pure_const_calls = []
+        self.funcs = {}
         ins = self.optimize_ins(ins, 0)
+        # Folding may have finalized bodies before they were optimized
+        for func in self.funcs.values():
+            func.code = None
         if self.verbose:
             for opt in self.pure_const_calls:
                 debug.d('optimized', opt)
         return ins
+
+    def compile_global(self, ins):
+        return self.run(ins)
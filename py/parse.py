@@ -2,17 +2,31 @@
 import cons as c
 import debug
 import error
+import source
 
+import re
 import sys
 
-TERM_EOF = 0
-TERM_CLOSE_PAREN = 1
-TERM_WHITESPACE = 2
-TERM_DQUOTE = 3
-TERM_DOT = 4
-TERM_MATCHED = 5
+TOKEN_EOF = 0
+TOKEN_OPEN = 1
+TOKEN_CLOSE = 2
+TOKEN_DOT = 3
+TOKEN_QUOTE = 4
+TOKEN_STRING = 5
+TOKEN_COMMENT = 6
+TOKEN_MULTILINE_COMMENT = 7
+TOKEN_VECTOR = 8
+TOKEN_SYMBOLISH = 9
+TOKEN_MORE = 10 # end of the input received so far, see source.Stream
 
-list_id = 0
+# One match per token, the matching group number is the token type
+token_re = re.compile(r"""\s*(?:(\()|(\))|(\.)|(')|(")|(;)|(\#\|)|(\#\()|([^\s)]+)|)""")
+string_re = re.compile(r'[^"\\]*')
+
+escapes = { 'n': '\n', '\\': '\\' }
+
+# Characters that may start something int() or float() accepts
+number_start = frozenset('0123456789+-iInN')
 
 class NoValueError(error.Error):
     pass
@@ -20,202 +34,271 @@ class NoValueError(error.Error):
 class EOFError(error.Error):
     pass
 
-class SingleLineError(error.Error):
-    pass
+class Tokenizer:
+    """Splits a source.CharIterator into tokens, scanning a whole line at a
+    time with regexes instead of reading single characters.
+    Tokens are (token type, value, tag) where the tag points at the first
+    character of the token.
+    When a reader that is waiting for more input runs dry, TOKEN_MORE is
+    returned. A string or comment left open is resumed by the next call"""
 
-def parse_iterator(iterator):
-    can_tag = hasattr(iterator, 'get_tag')
+    def __init__(self, reader):
+        self.reader = reader
+        # (token type, tag, string parts) of an unfinished string or comment
+        self.resume = None
 
-    def get_tag():
-        return iterator.get_tag() if can_tag else None
+    def next(self):
+        r = self.reader
+        if self.resume:
+            (token, tag, parts) = self.resume
+            self.resume = None
+            if token == TOKEN_STRING:
+                value = self.scan_string(tag, parts)
+                if value is None:
+                    return (TOKEN_MORE, None, tag)
+                return (token, value, tag)
+            elif not self.skip_multiline_comment(tag):
+                return (TOKEN_MORE, None, tag)
+
+        while True:
+            m = token_re.match(r.line_str, r.pos)
+            token = m.lastindex
+            if token is None:
+                # Only whitespace left on this line
+                if not r.nextline():
+                    if r.waiting():
+                        return (TOKEN_MORE, None, None)
+                    return (TOKEN_EOF, None, r.get_tag())
+                continue
 
-    def attach_tag(cons, tag):
-        if tag:
-            cons.tag = tag
-        return cons
+            start = m.start(token)
+            r.pos = m.end()
+            if token == TOKEN_SYMBOLISH:
+                return (token, m.group(token), r.tag_at(start))
+            elif token == TOKEN_COMMENT:
+                r.pos = len(r.line_str)
+            elif token == TOKEN_MULTILINE_COMMENT:
+                tag = r.tag_at(start)
+                if not self.skip_multiline_comment(tag):
+                    return (TOKEN_MORE, None, tag)
+            elif token == TOKEN_STRING:
+                tag = r.tag_at(start)
+                value = self.scan_string(tag, [])
+                if value is None:
+                    return (TOKEN_MORE, None, tag)
+                return (token, value, tag)
+            else:
+                return (token, None, r.tag_at(start))
+
+    def skip_multiline_comment(self, tag):
+        "Returns False if the input ran dry before the end of the comment"
+        r = self.reader
+        while True:
+            end = r.line_str.find('|#', r.pos)
+            if end >= 0:
+                r.pos = end + 2
+                return True
+            r.pos = len(r.line_str)
+            if not r.nextline():
+                if r.waiting():
+                    self.resume = (TOKEN_MULTILINE_COMMENT, tag, None)
+                    return False
+                raise error.gen(EOFError, 'non-terminated comment', tag=tag)
+
+    def scan_string(self, tag, parts):
+        "Returns None if the input ran dry before the end of the string"
+        r = self.reader
+        while True:
+            line = r.line_str
+            end = string_re.match(line, r.pos).end()
+            parts.append(line[r.pos:end])
+            if end == len(line):
+                r.pos = end
+                if not r.nextline():
+                    if r.waiting():
+                        self.resume = (TOKEN_STRING, tag, parts)
+                        return None
+                    raise error.gen(EOFError, 'non-terminated string', tag=tag)
+            elif line[end] == '"':
+                r.pos = end + 1
+                return ''.join(parts)
+            else:
+                # Escape sequence
+                esc = line[end + 1:end + 2]
+                if esc not in escapes:
+                    raise error.Error('invalid escape character: \\' + esc, tag=r.tag_at(end))
+                parts.append(escapes[esc])
+                r.pos = end + 2
 
-    def create_symbolish(s, tag):
+def create_symbolish(s, tag):
+    "Number if s reads as one, otherwise a Symbol. Symbols are interned and not tagged"
+    if s[0] in number_start:
         try:
-            val = c.Number(int(s))
-        except:
+            value = c.Number(int(s))
+        except ValueError:
             try:
-                val = c.Number(float(s))
-            except:
-                val = c.Symbol(s)
-        return attach_tag(val, tag)
-
-    def parse_symbolish(i, init):
-        tag = get_tag()
-        string = init
+                value = c.Number(float(s))
+            except ValueError:
+                return c.Symbol(s)
+        value.tag = tag
+        return value
+    return c.Symbol(s)
+
+# Parser stack frames are [kind, first pair, last pair, tag]
+FRAME_LIST = 0
+FRAME_DOT = 1 # after the dot of a dotted list
+FRAME_TAIL = 2 # after the element following the dot
+FRAME_QUOTE = 3
+FRAME_VECTOR = 4 # [kind, items, None, tag]
+
+class Parser:
+    """Builds cons trees from tokens with an explicit stack instead of
+    recursion, so nesting depth is only limited by memory.
+    Lists are tagged with the position of their '(', list cells with the
+    position of their element"""
+
+    def __init__(self):
+        self.stack = []
+
+    def parse(self, next_token):
+        """Read tokens from next_token() until a complete value is parsed.
+        Returns None on TOKEN_MORE, keeping the partial value for the next call"""
+        stack = self.stack
         while True:
-            try:
-                ch = i.__next__()
-                if ch == ' ' or ch == '\n':
-                    return (create_symbolish(string, tag), TERM_WHITESPACE)
-                elif ch == ')':
-                    return (create_symbolish(string, tag), TERM_CLOSE_PAREN)
-                else:
-                    string += ch
-            except StopIteration:
-                return (create_symbolish(string, tag), TERM_EOF)
-
-    def parse_list(i):
-        # debug
-        global list_id
-        lid = list_id
-        list_id += 1
-
-        tag = get_tag()
-        (element, term) = parse_unknown(i)
-        #debug.d('parse list ', lid, ' (initial): ', element, ' ', 'term=', term)
-        if not element:
-            if term != TERM_CLOSE_PAREN:
-                raise error.Error('weird list', tag=tag)
-            return (attach_tag(c.Null(), tag), TERM_MATCHED)
-        else:
-            head = None
-            current = None
-            index = 0
-            while True:
-                #debug.d('parse list ', lid, '#', index, ': ', element, ' term=', term)
-                if term == TERM_CLOSE_PAREN:
-                    if not element:
-                        current.cdr = attach_tag(c.Null(), tag)
-                    elif current:
-                        current.cdr = attach_tag(c.Pair(element, attach_tag(c.Null(), get_tag())), tag)
+            (token, value, tag) = next_token()
+            if token == TOKEN_SYMBOLISH:
+                element = create_symbolish(value, tag)
+            elif token == TOKEN_OPEN:
+                stack.append([FRAME_LIST, None, None, tag])
+                continue
+            elif token == TOKEN_VECTOR:
+                stack.append([FRAME_VECTOR, [], None, tag])
+                continue
+            elif token == TOKEN_CLOSE:
+                if not stack or stack[-1][0] == FRAME_QUOTE:
+                    raise error.Error('unexpected )', tag=tag)
+                (kind, element, last, list_tag) = stack.pop()
+                if kind == FRAME_DOT:
+                    raise error.Error('malformed dot notation', tag=tag)
+                elif kind == FRAME_VECTOR:
+                    element = c.Vector(element)
+                    element.tag = list_tag
+                elif element is None:
+                    element = c.NULL
+                tag = list_tag
+            elif token == TOKEN_STRING:
+                element = c.String(value)
+                element.tag = tag
+            elif token == TOKEN_QUOTE:
+                stack.append([FRAME_QUOTE, None, None, tag])
+                continue
+            elif token == TOKEN_DOT:
+                if not stack or stack[-1][0] != FRAME_LIST or stack[-1][1] is None:
+                    raise error.Error('malformed dot notation', tag=tag)
+                stack[-1][0] = FRAME_DOT
+                continue
+            elif token == TOKEN_MORE:
+                return None
+            else:
+                self.raise_eof()
+
+            # Add the completed element to the enclosing frames
+            while stack:
+                frame = stack[-1]
+                kind = frame[0]
+                if kind == FRAME_QUOTE:
+                    stack.pop()
+                    element = c.Quote(element)
+                    element.tag = tag = frame[3]
+                elif kind == FRAME_LIST:
+                    p = c.Pair(element, c.NULL)
+                    if frame[1] is None:
+                        p.tag = frame[3]
+                        frame[1] = p
                     else:
-                        head = attach_tag(c.Pair(element, attach_tag(c.Null(), get_tag())), tag)
+                        p.tag = tag
+                        frame[2].cdr = p
+                    frame[2] = p
+                    break
+                elif kind == FRAME_VECTOR:
+                    frame[1].append(element)
                     break
-                elif term == TERM_DOT:
-                    tag = get_tag()
-                    (element, term) = parse_unknown(i)
-                    #debug.d('parse list ', lid, ' (post-dot)', index, ': ', element, ' term=', term)
-                    if term != TERM_CLOSE_PAREN:
-                        (_, term) = parse_close_paren(i)
-                    if term != TERM_CLOSE_PAREN:
-                        raise error.Error('malformed dot notation', tag=get_tag())
-                    current.cdr = element
+                elif kind == FRAME_DOT:
+                    frame[2].cdr = element
+                    frame[0] = FRAME_TAIL
                     break
-                elif term == TERM_EOF:
-                    raise error.gen(EOFError, 'non-terminated list', tag=get_tag())
                 else:
-                    p = attach_tag(c.Pair(element, None), tag)
-                    if current:
-                        current.cdr = p
-                    else:
-                        head = p
-                    current = p
-
-                tag = get_tag()
-                (element, term) = parse_unknown(i)
-                index += 1
-            return (head, TERM_MATCHED)
-
-    def parse_singleline_comment(i):
-        if not can_tag:
-            raise error.gen(SingleLineError, msg="single line comment not supported")
-        tag = get_tag()
-        row = tag[0].row
-        try:
-            while True:
-                i.__next__()
-                if get_tag()[0].row != row:
-                    return (None, TERM_MATCHED)
-        except StopIteration:
+                    raise error.Error('malformed dot notation', tag=tag)
+            else:
+                return element
+
+    def raise_eof(self):
+        "Errors point at the unfinished quote or list"
+        stack = self.stack
+        if not stack:
             raise NoValueError()
+        frame = stack[-1]
+        self.stack = []
+        if frame[0] == FRAME_QUOTE:
+            raise error.gen(EOFError, 'unexpected EOF', tag=frame[3])
+        raise error.gen(EOFError, 'non-terminated list', tag=frame[3])
 
-    def parse_multiline_comment(i):
-        try:
-            while True:
-                ch = i.__next__()
-                if ch == '|':
-                    ch = i.__next__()
-                    if ch == '#':
-                        return (None, TERM_MATCHED)
-        except StopIteration:
-            raise error.gen(EOFError, 'non-terminated comment', tag=get_tag())
-
-    def parse_string(i):
-        tag = get_tag()
-        string = ''
-        try:
-            while True:
-                ch = i.__next__()
-                if ch == '\\':
-                    # Escape sequences
-                    ch = i.__next__()
-                    if ch == 'n':
-                        string += '\n'
-                    elif ch == '\\':
-                        string += '\\'
-                    else:
-                        raise error.Error('invalid escape character: \\' + ch)
-                elif ch == '"':
-                    return (attach_tag(c.String(string), tag), TERM_DQUOTE)
-                else:
-                    string += ch
-        except StopIteration:
-            raise error.gen(EOFError, 'non-terminated string', tag=get_tag())
+def parse_iterator(iterator):
+    return Parser().parse(Tokenizer(iterator).next)
 
-    def parse_close_paren(i):
-        while True:
-            ch = i.__next__()
-            if ch.isspace():
-                continue
-            if ch == ')':
-                return (None, TERM_CLOSE_PAREN)
-            else:
-                return (None, TERM_UNEXPECTED)
+class IncrementalParser:
+    """Push-style parser. Text is fed in chunks as it arrives, and each
+    feed() returns the top-level values completed so far. Partial values,
+    strings and comments are kept between chunks, so no text is scanned twice"""
+    def __init__(self, name):
+        self.reader = iter(source.Stream(name))
+        self.tokens = Tokenizer(self.reader)
+        self.parser = Parser()
 
-    def parse_unknown(i):
-        while True:
-            try:
-                ch = i.__next__()
-            except StopIteration:
-                return (None, TERM_EOF)
+    def feed(self, text):
+        """Returns the values completed by text. On a syntax error the input
+        buffered so far is dropped, see reset(), and the error is raised"""
+        self.reader.feed(text)
+        return self.parse_available()
 
-            if ch.isspace():
-                continue
-            elif ch == ')':
-                return (None, TERM_CLOSE_PAREN)
-            elif ch == '.':
-                return (None, TERM_DOT)
-            elif ch == '(':
-                return parse_list(i)
-            elif ch == '"':
-                return parse_string(i)
-            elif ch == "'":
-                tag = get_tag()
-                (quoted, term) = parse_unknown(i)
-                return (attach_tag(c.Quote(quoted), tag), term)
-            elif ch == ';':
-                parse_singleline_comment(i)
-            elif ch == '#':
-                ch = i.__next__()
-                if ch == '|':
-                    parse_multiline_comment(i)
-                else:
-                    return parse_symbolish(i, '#' + ch)
-            else:
-                return parse_symbolish(i, ch)
+    def close(self):
+        """Mark the end of the input. Returns the values completed by a last
+        line without newline, raises EOFError if a value is unfinished"""
+        self.reader.close()
+        return self.parse_available()
 
-    try:
-        (cons, term) = parse_unknown(iterator)
-    except StopIteration:
-        raise error.gen(EOFError, 'unexpected EOF', tag=get_tag())
+    def pending(self):
+        "True if part of a value has been read"
+        return bool(self.parser.stack) or self.tokens.resume is not None
 
-    if not cons:
-        raise NoValueError()
+    def reset(self):
+        "Drop the partial value and the input not parsed yet"
+        self.parser.stack = []
+        self.tokens.resume = None
+        self.reader.discard()
 
-    return cons
+    def parse_available(self):
+        values = []
+        try:
+            while True:
+                value = self.parser.parse(self.tokens.next)
+                if value is None:
+                    return values
+                values.append(value)
+        except NoValueError:
+            return values
+        except error.Error:
+            self.reset()
+            raise
 
 def parse_one(source):
     iterator = iter(source)
     try:
         res = parse_iterator(iterator)
-        trail = ''.join([x for x in iterator])
-        if len(trail.strip()) != 0:
-            raise error.Error('trailing characters: ' + trail)
+        (token, value, tag) = Tokenizer(iterator).next()
+        if token != TOKEN_EOF:
+            trail = tag[0].line_str[tag[1] - 1:].rstrip()
+            raise error.Error('trailing characters: ' + trail, tag=tag)
         return res
     finally:
         iterator.close()
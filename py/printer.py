@@ -0,0 +1,108 @@
+
+import cons
+
+import io
+
+# Number of output fragments to collect before writing them to the stream
+FLUSH_PARTS = 4096
+
+def write(out, value, max_depth=None, max_length=None):
+    """Write the s-expression for value to the text stream out.
+    Lists are walked with an explicit stack, so deep nesting does not
+    recurse and the time taken is linear in the size of the output.
+    max_depth -- lists nested deeper than this are written as ...
+    max_length -- elements of a list after the first max_length are written as ..."""
+    parts = []
+    append = parts.append
+    # Lists being written: [current pair, elements written so far].
+    # A None pair means the dotted tail is done and the list should be closed
+    stack = []
+    while True:
+        # Write one value, descending into the first element of lists
+        while True:
+            cls = value.__class__
+            if cls is cons.Pair:
+                if max_depth is not None and len(stack) >= max_depth:
+                    append('...')
+                    break
+                append('(')
+                stack.append([value, 1])
+                value = value.car
+            elif cls is cons.Quote:
+                append("'")
+                value = value.value
+            elif cls is cons.Vector:
+                if max_depth is not None and len(stack) >= max_depth:
+                    append('...')
+                    break
+                if not value.items:
+                    append('#()')
+                    break
+                # Written as a list of its items
+                append('#')
+                value = cons.lst(*value.items)
+            else:
+                append(value.sexpr())
+                break
+
+        if len(parts) >= FLUSH_PARTS:
+            out.write(''.join(parts))
+            parts = []
+            append = parts.append
+
+        # Move on to the next element that needs descending into,
+        # writing atoms on the way and closing finished lists
+        while stack:
+            top = stack[-1]
+            p = top[0]
+            if p is None:
+                append(')')
+                stack.pop()
+                continue
+
+            n = top[1]
+            p = p.cdr
+            while p.__class__ is cons.Pair:
+                value = p.car
+                cls = value.__class__
+                if (cls is cons.Pair or cls is cons.Quote or cls is cons.Vector or
+                    (max_length is not None and n >= max_length)):
+                    break
+                append(' ' + value.sexpr())
+                n += 1
+                p = p.cdr
+            else:
+                if p is cons.NULL:
+                    append(')')
+                    stack.pop()
+                else:
+                    append(' . ')
+                    top[0] = None
+                    value = p
+                    break
+                continue
+
+            if max_length is not None and n >= max_length:
+                append(' ...)')
+                stack.pop()
+                continue
+            append(' ')
+            top[0] = p
+            top[1] = n + 1
+            break
+        else:
+            out.write(''.join(parts))
+            return
+
+def sexpr(value, max_depth=None, max_length=None):
+    'The s-expression for value as a string'
+    out = io.StringIO()
+    write(out, value, max_depth, max_length)
+    return out.getvalue()
+
+def display(out, value):
+    'Write value the way the display builtin shows it: strings without quotes'
+    if value.__class__ is cons.String:
+        out.write(value.string)
+    else:
+        write(out, value)
@@ -4,7 +4,12 @@ import debug
 import eval
 import parse
 
+import array
+import bisect
+import collections
 import io
+import linecache
+import mmap
 
 class Line:
     def __init__(self, sourcefile, line_str, row):
@@ -12,44 +17,181 @@ class Line:
         self.line_str = line_str
         self.row = row
 
+    def __reduce__(self):
+        return (CachedLine, (self.sourcefile.name, self.row))
+
+class CachedLine:
+    "Line of a tag loaded from the compile cache. Text is read on demand"
+    def __init__(self, name, row):
+        self.sourcefile = File(name)
+        self.row = row
+
+    @property
+    def line_str(self):
+        return linecache.getline(self.sourcefile.name, self.row)
+
+    def __reduce__(self):
+        return (CachedLine, (self.sourcefile.name, self.row))
+
 class CharIterator:
+    """Reads a source a line at a time.
+    line_str -- the current line, including its newline
+    pos -- index into line_str of the next character to read
+    Characters can be read one by one, or scanned in bulk from
+    line_str/pos as parse.Tokenizer does."""
     def __init__(self, source, f):
         self.name = source.name
         self.f = f
-        self.line_str = None
+        self.line_str = ''
+        self.pos = 0
         self.row = 0
-        self.column = 0
         self.line_obj = None
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if not self.line_str:
-            self.nextline()
-        else:
-            self.column += 1
-            if self.column == len(self.line_str):
-                self.nextline()
-        return self.line_str[self.column]
+        while self.pos == len(self.line_str):
+            if not self.nextline():
+                raise StopIteration
+        ch = self.line_str[self.pos]
+        self.pos += 1
+        return ch
 
     def nextline(self):
+        "Advance to the next line. Returns False on EOF"
         if self.line_str:
             self.row += 1
         self.line_str = self.f.readline()
-        if len(self.line_str) == 0:
-            raise StopIteration
-        self.column = 0
+        self.pos = 0
         self.line_obj = None
+        return len(self.line_str) != 0
 
     def get_tag(self):
+        "Tag of the last read character"
+        return self.tag_at(self.pos - 1)
+
+    def tag_at(self, pos):
+        "Tag of the character at index pos of the current line"
         if not self.line_obj:
             self.line_obj = Line(self, self.line_str, self.row + 1)
-        return (self.line_obj, self.column + 1)
+        return (self.line_obj, pos + 1)
+
+    def waiting(self):
+        "True if the input has ended for now, but more may come later"
+        return False
 
     def close(self):
         self.f.close()
 
+class StreamIterator(CharIterator):
+    """CharIterator fed with chunks of text, see Stream.
+    Only complete lines are handed out until close() marks the end of
+    the input, so a token is never split between chunks"""
+    def __init__(self, source):
+        CharIterator.__init__(self, source, None)
+        self.lines = collections.deque()
+        self.partial = ''
+        self.closed = False
+
+    def feed(self, text):
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        self.lines.extend([line + '\n' for line in lines])
+
+    def discard(self):
+        "Drop all input not read yet"
+        self.lines.clear()
+        self.partial = ''
+        self.pos = len(self.line_str)
+
+    def nextline(self):
+        if self.lines:
+            line = self.lines.popleft()
+        elif self.closed and self.partial:
+            line = self.partial
+            self.partial = ''
+        else:
+            # Keep the current line, more input may follow
+            return False
+        if self.line_str:
+            self.row += 1
+        self.line_str = line
+        self.pos = 0
+        self.line_obj = None
+        return True
+
+    def waiting(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+class MappedLine:
+    "Line of a MappedFile in a tag. Row and text are looked up on demand"
+    def __init__(self, sourcefile, offset):
+        self.sourcefile = sourcefile
+        self.offset = offset
+
+    @property
+    def row(self):
+        return bisect.bisect_right(self.sourcefile.line_offsets, self.offset)
+
+    @property
+    def line_str(self):
+        return self.sourcefile.decode_line(self.offset)
+
+    def __reduce__(self):
+        return (CachedLine, (self.sourcefile.name, self.row))
+
+class MappedIterator(CharIterator):
+    """CharIterator over a memory mapped file. Lines are decoded one at a
+    time from a memoryview of the map, and tags refer to byte offsets so
+    no line text is kept alive by parsed values. The map stays open as
+    long as tags refer to it."""
+    def __init__(self, source):
+        CharIterator.__init__(self, source, None)
+        self.encoding = source.encoding
+        with open(source.name, 'rb') as f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped
+                self.map = b''
+        self.view = memoryview(self.map)
+        self.offset = 0
+        self.next_offset = 0
+        self.line_offsets = array.array('q')
+
+    def nextline(self):
+        if self.line_str:
+            self.row += 1
+        self.offset = self.next_offset
+        end = self.map.find(b'\n', self.offset)
+        end = len(self.map) if end < 0 else end + 1
+        self.line_str = str(self.view[self.offset:end], self.encoding)
+        self.next_offset = end
+        self.pos = 0
+        self.line_obj = None
+        if len(self.line_str) == 0:
+            return False
+        self.line_offsets.append(self.offset)
+        return True
+
+    def tag_at(self, pos):
+        if not self.line_obj:
+            self.line_obj = MappedLine(self, self.offset)
+        return (self.line_obj, pos + 1)
+
+    def decode_line(self, offset):
+        end = self.map.find(b'\n', offset)
+        end = len(self.map) if end < 0 else end + 1
+        return str(self.view[offset:end], self.encoding)
+
+    def close(self):
+        # Keep the map, tags may still need line text for error messages
+        pass
+
 class File:
     def __init__(self, name):
         self.name = name
@@ -64,3 +206,20 @@ class String:
 
     def __iter__(self):
         return CharIterator(self, io.StringIO(self.s))
+
+class Stream:
+    'Source that is fed text as it arrives, from a REPL, pipe or socket'
+    def __init__(self, name):
+        self.name = name
+
+    def __iter__(self):
+        return StreamIterator(self)
+
+class MappedFile:
+    'Source file read through mmap, for very large data files'
+    def __init__(self, name, encoding='utf-8'):
+        self.name = name
+        self.encoding = encoding
+
+    def __iter__(self):
+        return MappedIterator(self)
@@ -1,13 +1,16 @@
 #! /usr/bin/env python3
 
 import basics
+import cache
 import comp
 import cons
 import cons_util
 import debug
 import eval
+import function
 import error
 import parse
+import printer
 import source
 
 import argparse
@@ -20,9 +23,15 @@ desc = 'Scheme programming.'
 
 ap = argparse.ArgumentParser(prog='sprog',
                              description=desc)
-ap.add_argument('files', nargs='*', default=[])
+ap.add_argument('files', nargs='*', default=[], help="source files, - reads forms from stdin as they arrive")
 ap.add_argument('--verbose_compile', help='run with verbose compiler', action='store_true')
 ap.add_argument('--verbose_eval', help='run with verbose evaluator', action='store_true')
+ap.add_argument('--no_cache', help='do not use the ' + cache.CACHE_DIR + ' compile cache', action='store_true')
+ap.add_argument('--optimize', help='fold constant calls at compile time', action='store_true')
+ap.add_argument('--memo', help='cache the results of up to MEMO calls to pure functions', type=int, default=0)
+ap.add_argument('--memo_stats', help='show memo hits and misses on exit', action='store_true')
+ap.add_argument('--print_depth', help='list nesting shown by the REPL', type=int, default=20)
+ap.add_argument('--print_length', help='list elements shown by the REPL', type=int, default=200)
 
 args = ap.parse_args()
 
@@ -31,34 +40,44 @@ env = eval.Env(debug.stream_tree())
 basics.define_basics(env)
 basics.define_loops(env)
 
+if args.memo > 0:
+    env.memo = function.Memo(args.memo)
+
 env.dbg.comp.set_enabled(args.verbose_compile)
 env.dbg.eval.set_enabled(args.verbose_eval)
 
-def eval_iterator(i):
-    try:
-        for ins in comp.compile_iterator(i, env, debuggable=True):
-            env.eval(ins)
-    finally:
-        i.close()
+def eval_file(fn):
+    for ins in cache.compile_file(fn, env, debuggable=True, use_cache=not args.no_cache,
+                                  optimizing=args.optimize):
+        env.eval(ins)
+
+def eval_print(value):
+    value = env.eval(comp.compile_expr(value, env, debuggable=True, optimizing=args.optimize))
+    printer.write(sys.stdout, value, max_depth=args.print_depth, max_length=args.print_length)
+    sys.stdout.write('\n')
 
-def read_eval_print(track_name):
-    print(
-        env.eval(
-            comp.compile_expr(
-                parse.parse_one(source.String(track_name, input('sprog> ') + '\n')),
-                env, debuggable=True)).sexpr())
+def eval_stream(f, name):
+    "Evaluate each form as soon as it has been read from f"
+    reader = parse.IncrementalParser(name)
+    for line in f:
+        for value in reader.feed(line):
+            env.eval(comp.compile_expr(value, env, debuggable=True, optimizing=args.optimize))
+    for value in reader.close():
+        env.eval(comp.compile_expr(value, env, debuggable=True, optimizing=args.optimize))
 
 def read_eval_print_loop():
-    i = 0
+    reader = parse.IncrementalParser('REPL')
     while True:
-        i += 1
         try:
-            read_eval_print('REPL#' + str(i))
-        except parse.NoValueError:
-            continue
-        except parse.SingleLineError:
-            continue
+            line = input('...    ' if reader.pending() else 'sprog> ')
+            for value in reader.feed(line + '\n'):
+                eval_print(value)
         except KeyboardInterrupt as e:
+            print('')
+            if not reader.pending():
+                return
+            reader.reset()
+        except EOFError as e:
             print('')
             return
         except error.Error as e:
@@ -70,6 +89,12 @@ readline.parse_and_bind('tab: complete')
 
 if len(args.files):
     for fn in args.files:
-        eval_iterator(iter(source.File(fn)))
+        if fn == '-':
+            eval_stream(sys.stdin, 'stdin')
+        else:
+            eval_file(fn)
 else:
     read_eval_print_loop()
+
+if args.memo_stats and env.memo:
+    sys.stderr.write(str(env.memo) + '\n')
@@ -1,16 +1,24 @@
 #! /usr/bin/env python3
 
 import basics
+import cache
 import comp
 import cons
+import cons_util
 import debug
 import error
 import eval
+import function
+import instr
 import parse
+import printer
 import source
 
 import io
+import os
+import pickle
 import sys
+import tempfile
 import unittest
 
 dbg = debug.stream_tree()
@@ -55,6 +63,16 @@ class test_parse(unittest.TestCase):
         self.assertParseEqual('( 1 )', cons.lst(cons.Number(1)))
         self.assertParseEqual('( 1 . 2 )', cons.Pair(cons.Number(1), cons.Number(2)))
 
+    def test_vector(self):
+        self.assertParseEqual('#()', cons.Vector([]))
+        self.assertParseEqual('#(1 (2) #("s") a)', cons.Vector([cons.Number(1),
+                                                                cons.lst(cons.Number(2)),
+                                                                cons.Vector([cons.String('s')]),
+                                                                cons.Symbol('a')]))
+        self.assertEqual(self.parse('(a #(1))').cdr.car.tag[1], 4)
+        self.assertRaises(error.Error, self.parse, '#(1 . 2)')
+        self.assertRaises(parse.EOFError, self.parse, '#(1')
+
     def test_literal(self):
         self.assertParseEqual('hello', cons.Symbol('hello'))
         self.assertParseEqual('"hello"', cons.String('hello'))
@@ -66,6 +84,19 @@ class test_parse(unittest.TestCase):
         self.assertRaises(parse.EOFError, self.parse, '(list')
         self.assertRaises(parse.EOFError, self.parse, '#| comment')
         self.assertRaises(parse.EOFError, self.parse, '"string')
+        with self.assertRaises(parse.EOFError) as cm:
+            self.parse("\n  '")
+        self.assertEqual(cm.exception.tag[0].row, 2)
+        self.assertEqual(cm.exception.tag[1], 3)
+        for src in ['(a . )', '(a . b c)', '(. a)', '.', "(a ')", ')']:
+            self.assertRaises(error.Error, self.parse, src)
+
+    def test_deep(self):
+        value = self.parse('(' * 100000 + "'(a . b)" + ')' * 100000)
+        for n in range(100000):
+            self.assertIs(value.cdr, cons.NULL)
+            value = value.car
+        self.assertEqual(value.sexpr(), "'(a . b)")
 
     def test_number(self):
         self.assertParseEqual('-2', cons.Number(-2))
@@ -73,12 +104,105 @@ class test_parse(unittest.TestCase):
         self.assertParseEqual('0.1', cons.Number(0.1))
         self.assertParseEqual('-0.1', cons.Number(-0.1))
 
+    def test_comment(self):
+        self.assertParseEqual('; comment\n(1 ; comment\n 2) ; comment',
+                              cons.lst(cons.Number(1), cons.Number(2)))
+        self.assertParseEqual('(1 #| multi\nline |# 2)',
+                              cons.lst(cons.Number(1), cons.Number(2)))
+
+    def test_tag(self):
+        value = self.parse('(a\n  (b "c"))')
+        self.assertEqual(value.tag[1], 1)
+        self.assertEqual(value.cdr.car.tag[0].row, 2)
+        self.assertEqual(value.cdr.car.tag[1], 3)
+        self.assertEqual(value.cdr.car.cdr.car.tag[1], 6)
+
+    def test_interned(self):
+        value = self.parse("(a (a) () 'a)")
+        self.assertIs(value.car, cons.Symbol('a'))
+        self.assertIs(value.cdr.car.car, value.car)
+        self.assertIs(value.cdr.car.cdr, cons.Null())
+        self.assertIs(value.cdr.cdr.car, cons.Null())
+        self.assertIs(value.cdr.cdr.cdr.car.value, value.car)
+        self.assertIs(pickle.loads(pickle.dumps(value)).car, value.car)
+        self.assertIs(pickle.loads(pickle.dumps(cons.Void())), cons.Void())
+        self.assertIs(cons.from_py(1 < 2), cons.true())
+
+    def test_compact(self):
+        value = self.parse("(1 \"a\" 'b)")
+        for c in [value, value.car, value.cdr.car, value.cdr.cdr.car, instr.LoadLocal(0),
+                  function.Locals(1, None)]:
+            self.assertFalse(hasattr(c, '__dict__'), c.__class__.__name__)
+        self.assertEqual(value.cdr.car.tag[1], 4)
+        self.assertFalse(hasattr(cons.Pair(value, value), 'tag'))
+
+    def test_incremental(self):
+        text = '(a "b\nc" ; d\n (e . f)) #| g\n|# \'h 12 ("i")'
+        expect = ['(a "b\nc" (e . f))', "'h", '12', '("i")']
+        for split in range(len(text) + 1):
+            p = parse.IncrementalParser(self.id())
+            values = p.feed(text[:split]) + p.feed(text[split:]) + p.close()
+            self.assertEqual([v.sexpr() for v in values], expect)
+
+        p = parse.IncrementalParser(self.id())
+        self.assertEqual(p.feed('(a\n'), [])
+        self.assertTrue(p.pending())
+        self.assertEqual(p.feed('"b\n'), [])
+        values = p.feed('c") d\n')
+        self.assertFalse(p.pending())
+        self.assertEqual([v.sexpr() for v in values], ['(a "b\nc")', 'd'])
+        self.assertEqual(values[0].cdr.tag[0].row, 2)
+
+        self.assertRaises(error.Error, p.feed, '(x y))\n')
+        self.assertFalse(p.pending())
+        self.assertEqual([v.sexpr() for v in p.feed('(z\n')], [])
+        self.assertRaises(parse.EOFError, p.close)
+
     def test_string(self):
         self.assertParseEqual('"hei"', cons.String('hei'))
         self.assertParseEqual('"and\\nor"', cons.String('and\nor'))
         self.assertRaises(error.Error, self.parse, '"\escape"')
 
-class test_eval(unittest.TestCase):
+    def test_mapped_file(self):
+        text = '(a "b")\n; comment\n(c\n  (d . 1.5) "\u00e9" e)\n\n(f "g'
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'mapped.spr')
+            with open(fn, 'w', encoding='utf-8') as f:
+                f.write(text)
+            for i in [iter(source.File(fn)), iter(source.MappedFile(fn))]:
+                self.assertEqual(parse.parse_iterator(i).sexpr(), '(a "b")')
+                value = parse.parse_iterator(i)
+                self.assertEqual(value.sexpr(), '(c (d . 1.5) "\u00e9" e)')
+                self.assertEqual(debug.describe_tag(value.cdr.cdr.cdr.tag), fn + ':4:17')
+                self.assertEqual(debug.point_to_tag(value.cdr.tag), '  (d . 1.5) "\u00e9" e)\n~~^')
+                with self.assertRaises(parse.EOFError) as cm:
+                    parse.parse_iterator(i)
+                self.assertEqual(debug.describe_tag(cm.exception.tag), fn + ':6:4')
+                i.close()
+
+def new_env():
+    env = eval.Env(debug.stream_tree())
+    basics.define_basics(env)
+    return env
+
+def eval_forms(env, forms, output=None):
+    """Evaluate compiled forms one at a time, as sprog.py does, so each form
+    is compiled after the ones before it have run. Returns the output"""
+    if output is None:
+        output = io.StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        for ins in forms:
+            env.eval_noexcept(ins)
+    finally:
+        sys.stdout = stdout
+    return output.getvalue()
+
+class eval_case(unittest.TestCase):
+    'Evaluates sources compiled as one module'
+    optimizing = False
+
     def eval_iterator(self, i, stdout_capture=None, with_basics=True, with_loops=False):
         env = eval.Env(dbg)
         if with_basics:
@@ -87,7 +211,7 @@ class test_eval(unittest.TestCase):
             basics.define_loops(env)
         result = None
         stdout = sys.stdout
-        ins = comp.compile_module(i, env, debuggable=True)
+        ins = comp.compile_module(i, env, debuggable=True, optimizing=self.optimizing)
         if stdout_capture:
             sys.stdout = stdout_capture
 
@@ -109,6 +233,13 @@ class test_eval(unittest.TestCase):
         result = self.eval_src(source, **kw)
         return result.equal(value)
 
+class test_eval(eval_case):
+    def test_empty(self):
+        # Forms compiling to no instructions, e.g. a module of definitions
+        self.assertDisplayEqual('(begin)', '')
+        self.assertDisplayEqual('(define (f) 1)', '')
+        self.assertDisplayEqual('', '')
+
     def test_map1(self):
         self.assertDisplayEqual("(display (map + '(1 2) '(1 2) '(1 2)))",
                                 '(3 6)', with_loops=True)
@@ -116,6 +247,20 @@ class test_eval(unittest.TestCase):
         self.assertDisplayEqual("(display (map car '((1) (2))))",
                                 '(1 2)', with_loops=True)
 
+    def test_map3(self):
+        self.assertDisplayEqual("""
+        (define (scale k) (lambda (x y) (* k (+ x y))))
+        (display (map (scale 2) '(1 2 3) '(10 20)))""",
+                                '(22 44)', with_loops=True)
+
+    def test_for_each1(self):
+        self.assertDisplayEqual("(for-each (lambda (x y) (display (list x y))) '(1 2) '(a b))",
+                                '(1 a)(2 b)', with_loops=True)
+
+    def test_apply1(self):
+        self.assertDisplayEqual("(display (apply + 1 2 '(3 4)))", '10')
+        self.assertDisplayEqual("(display (apply list '()))", '()')
+
     def test_closure1(self):
         self.assertDisplayEqual("""
         (define (test x) (lambda () x))
@@ -143,6 +288,207 @@ class test_eval(unittest.TestCase):
         (display (a))""",
                                 '012')
 
+    def test_frameless(self):
+        # even is frameless, odd needs a frame for its closure. Tail calls
+        # between them must not grow the stacks
+        self.assertDisplayEqual("""
+        (define (even n) (if (< n 1) true (odd (- n 1))))
+        (define (odd n) (if (< n 1) false ((lambda () (even (- n 1))))))
+        (define (sq x) (define y (* x x)) y)
+        (define (f a b) (define c (+ a (sq b))) (* c (sq (sq a))))
+        (display (list (even 10001) (f 2 3) (sq (f 1 1))))""",
+                                '(false 176 4)')
+
+    def test_call_arguments(self):
+        # Arguments of nested calls share the value stack
+        self.assertDisplayEqual("""
+        (define (add3 a b c) (+ a b c))
+        (define (twice f x) (f (f x 0 0) 0 0))
+        (display (list (add3 1 (add3 2 3 (- 10 (add3 1 1 1))) 4)
+                       (apply add3 1 '(2 3))
+                       (map add3 '(1 2) '(3 4) '(5 6))
+                       (twice add3 5)))""",
+                                '(17 6 (9 12) 5)', with_loops=True)
+        self.assertRaises(error.Error, self.eval_src, '(define (f a b) a) (f 1)')
+        self.assertRaises(error.Error, self.eval_src, '(1 2)')
+
+    def test_call_cc_escape(self):
+        self.assertDisplayEqual("""
+        (define (add3 a b c) (+ a b c))
+        (define (find x lst)
+          (call/cc (lambda (return)
+            (for-each (lambda (y) (if (equal? x y) (return true))) lst)
+            false)))
+        (display (list (add3 1 (call/cc (lambda (k) (add3 5 6 (k 2)))) 3)
+                       (find 2 '(1 2 3))
+                       (find 4 '(1 2 3))))""",
+                                '(6 true false)', with_loops=True)
+
+    def test_call_cc_reenter(self):
+        # Pending arguments and the rest of the module are run again each time
+        self.assertDisplayEqual("""
+        (define again false)
+        (define n 0)
+        (display (list 1 (call/cc (lambda (k) (set! again k) 2)) 3))
+        (set! n (+ n 1))
+        (if (< n 3) (again (* n 10)))""",
+                                '(1 2 3)(1 10 3)(1 20 3)')
+
+    def test_call_cc_generator(self):
+        self.assertDisplayEqual("""
+        (define (make-generator lst)
+          (define return false)
+          (define resume false)
+          (lambda ()
+            (call/cc (lambda (r)
+                       (set! return r)
+                       (if resume
+                           (resume false)
+                           (begin
+                             (for-each (lambda (x)
+                                         (call/cc (lambda (k)
+                                                    (set! resume k)
+                                                    (return x))))
+                                       lst)
+                             (return 'done)))))))
+        (define g (make-generator '(1 2 3)))
+        (display (list (g) (g) (g) (g) (g)))""",
+                                '(1 2 3 done done)', with_loops=True)
+
+    def test_call_cc_coroutines(self):
+        # Two coroutines passing control back and forth. When a is done it
+        # returns from the first call/cc, so b is started once more, and
+        # then returns to where it was first started
+        self.assertDisplayEqual("""
+        (define log '())
+        (define other false)
+        (define (switch next k)
+          (set! other k)
+          (next false))
+        (define (transfer)
+          (call/cc (lambda (k) (switch other k))))
+        (define (worker name n)
+          (if (> n 0)
+              (begin
+                (set! log (cons name log))
+                (transfer)
+                (worker name (- n 1)))))
+        (call/cc (lambda (k)
+                   (set! other k)
+                   (worker 'a 3)))
+        (worker 'b 3)
+        (display log)""",
+                                '(b b a b a b a)')
+
+    def test_call_ec(self):
+        self.assertDisplayEqual("""
+        (define (find x lst)
+          (call/ec (lambda (return)
+            (for-each (lambda (y) (if (equal? x y) (return y))) lst)
+            false)))
+        (define (first-pair lsts)
+          (call/ec (lambda (outer)
+            (for-each (lambda (lst)
+                        (call/ec (lambda (inner)
+                          (for-each (lambda (x)
+                                      (if (pair? x) (outer x))
+                                      (if (null? x) (inner false)))
+                                    lst))))
+                      lsts)
+            false)))
+        (display (list (find 2 '(1 2 3))
+                       (find 4 '(1 2 3))
+                       (+ 1 (call/ec (lambda (k) (+ 10 (k 2)))))
+                       (first-pair '((1 () (2)) (3 (4))))
+                       (first-pair '((1 () (2)) (5)))))""",
+                                '(2 false 3 (4) false)', with_loops=True)
+
+    def test_call_ec_returned(self):
+        with self.assertRaises(error.Error):
+            self.eval_src("""
+            (define saved false)
+            (call/ec (lambda (k) (set! saved k)))
+            (saved 1)""")
+        # An inner escape is gone once an outer one is taken
+        with self.assertRaises(error.Error):
+            self.eval_src("""
+            (define saved false)
+            (call/ec (lambda (outer)
+              (call/ec (lambda (inner) (set! saved inner) (outer 1)))))
+            (saved 2)""")
+
+    def test_call_ec_call_cc(self):
+        # Escaping after a continuation was captured, and re-entering it
+        self.assertDisplayEqual("""
+        (define again false)
+        (define n 0)
+        (display (list 1 (call/ec (lambda (k)
+                                    (+ 2 (call/cc (lambda (c) (set! again c) 0)) (k 5))))))
+        (set! n (+ n 1))
+        (if (< n 3) (again n))""",
+                                '(1 5)(1 5)(1 5)')
+
+    def test_globals(self):
+        # Globals defined after the functions using them
+        self.assertDisplayEqual("""
+        (define (get) x)
+        (define (put v) (set! x v))
+        (define (late n) (later n))
+        (define x 1)
+        (display (get))
+        (put 2)
+        (display (list (get) x))
+        (set! x 3)
+        (display (get))
+        (define (later n) (* n 10))
+        (display (late 3))""",
+                                '1(2 2)330')
+        with self.assertRaises(error.Error):
+            self.eval_src('(define (f) y) (f)')
+        with self.assertRaises(error.Error):
+            self.eval_src('(define (f) (set! g 1)) (define (g) 2) (f)')
+
+    def test_vector(self):
+        self.assertDisplayEqual("""
+        (define v (make-vector 3 0))
+        (vector-set! v 1 (vector 'a "b"))
+        (display (list v (vector-ref v 1) (vector-length v) (vector? v) (vector? '(1))))
+        (display (equal? #(1 (2)) (vector 1 (list 2))))""",
+                                '(#(0 #(a "b") 0) #(a "b") 3 true false)true')
+        self.assertRaises(error.Error, self.eval_src, '(vector-ref #(1 2) 2)')
+
+    def test_hash_table(self):
+        self.assertDisplayEqual("""
+        (define t (make-hash-table))
+        (hash-set! t '(1 "a") 'list)
+        (hash-set! t 2 'two)
+        (define e (make-hash-table 'eqv))
+        (hash-set! e 2 'two)
+        (display (list (hash-ref t (list 1 "a")) (hash-ref t 2.0) (hash-ref e 2)
+                       (hash-ref e 2.0 'none) (hash-table? e)))
+        (display t)""",
+                                '(list two two none true)#hash(((1 "a") . list) (2 . two))')
+        self.assertRaises(error.Error, self.eval_src, "(hash-ref (make-hash-table) 'a)")
+
+    def test_eq(self):
+        self.assertDisplayEqual("(display (list (eq? 'a 'a) (eq? 'a 'b) (eq? '() '()) (eq? \"a\" \"a\")))",
+                                '(true false true false)')
+
+    def test_symbol_tag(self):
+        with self.assertRaises(error.Error) as cm:
+            self.eval_src('(display\n  (list 1 undefined))')
+        self.assertEqual(cm.exception.tag[0].row, 2)
+        self.assertEqual(cm.exception.tag[1], 11)
+
+    def test_if_variable(self):
+        # The test is a local, a global or a literal, not a call
+        self.assertDisplayEqual("""
+        (define (f x) (if x 1 2))
+        (define g 5)
+        (define (h) (if g 3 4))
+        (display (list (f 1) (f false) (h) (if 1 2 3) (if false 2 3)))""",
+                                '(1 2 3 2 3)')
+
     def test_and1(self):
         self.assertDisplayEqual("(display (and true))", "true")
 
@@ -276,5 +622,395 @@ class test_eval(unittest.TestCase):
         with self.assertRaises(error.Error):
             self.eval_src('((lambda (a . b)))')
 
+    def test_tail_call(self):
+        "Tail calls run in constant stack space"
+        env = eval.Env(dbg)
+        basics.define_basics(env)
+        env.glob_const['stack-depth'] = function.Generic(
+            'stack-depth',
+            lambda: cons.Number(env.exe.depth()),
+            False)
+        ins = comp.compile_module(iter(source.String(self.id(), """
+        (define (loop n)
+          (if (> n 0)
+              (loop (- n 1))
+              (stack-depth)))
+        (define (even? n) (if (> n 0) (odd? (- n 1)) (stack-depth)))
+        (define (odd? n) (if (> n 0) (even? (- n 1)) (stack-depth)))
+        (list (loop 10) (loop 1000000) (even? 10) (even? 1000))""")), env)
+        depths = [x.number for x in cons_util.traverse_list(env.eval_noexcept(ins))]
+        self.assertEqual(depths[0], depths[1])
+        self.assertEqual(depths[2], depths[3])
+
+class test_eval_optimized(test_eval):
+    optimizing = True
+
+class test_optimize(unittest.TestCase):
+    def run_counted(self, src, optimizing):
+        env = new_env()
+        ins = comp.compile_module(iter(source.String(self.id(), src)), env, optimizing=optimizing)
+        counter = debug.InsCounter()
+        env.dbg.eval = counter
+        output = eval_forms(env, [ins])
+        return (output, counter.count, ins)
+
+    def assertFolded(self, src, display):
+        (plain_output, plain_count, plain_ins) = self.run_counted(src, False)
+        (output, count, ins) = self.run_counted(src, True)
+        self.assertEqual(plain_output, display)
+        self.assertEqual(output, display)
+        self.assertLess(count, plain_count)
+        self.assertEqual(len(ins), len(ins.tags))
+        return ins
+
+    def test_nested(self):
+        ins = self.assertFolded('(display (+ 1 (* 2 3)))', '7')
+        self.assertEqual(comp.get_load_literal(ins[1]).number, 7)
+        self.assertEqual(ins.tags[1][1], 10)
+
+    def test_if(self):
+        self.assertFolded('(define (f x) (if (< 1 2) (+ x (* 2 3)) (car 1))) (display (f 1))', '7')
+        self.assertFolded('(display (and (< 1 2) (> 3 1) 5))', '5')
+        self.assertFolded('(display (or (< 2 1) (+ 1 1)))', '2')
+
+    def test_not_folded(self):
+        # Errors are left to runtime, and new pairs are still allocated
+        (output, count, ins) = self.run_counted('(define (f) (list 1 2)) (display (eq? (f) (f)))', True)
+        self.assertEqual(output, 'false')
+        with self.assertRaises(error.Error) as cm:
+            self.run_counted('(display 1)\n(car 1)', True)
+        self.assertEqual(cm.exception.tag[0].row, 2)
+
+class test_purity(unittest.TestCase):
+    def define(self, src, optimizing=False):
+        "Compile and evaluate src form by form, returning the env"
+        env = new_env()
+        eval_forms(env, comp.compile_iterator(iter(source.String(self.id(), src)), env, optimizing=optimizing))
+        return env
+
+    def assertPurity(self, env, **expected):
+        for name, pure in expected.items():
+            self.assertEqual(env.glob_const[name.replace('_', '-')].is_pure(), pure, name)
+
+    def test_recursive(self):
+        env = self.define('(define (fact n) (if (< n 1) 1 (* n (fact (- n 1)))))'
+                          '(define (twice x) ((lambda (y) (+ x y)) x))')
+        self.assertPurity(env, fact=True, twice=True)
+
+    def test_mutually_recursive(self):
+        # even is compiled before odd is known, and upgraded when odd is defined
+        env = self.define('(define (even n) (if (< n 1) true (odd (- n 1))))')
+        self.assertPurity(env, even=False)
+        env = self.define('(define (even n) (if (< n 1) true (odd (- n 1))))'
+                          '(define (odd n) (if (< n 1) false (even (- n 1))))')
+        self.assertPurity(env, even=True, odd=True)
+
+    def test_chain(self):
+        # Upgrades reach the callers of upgraded functions, whichever order
+        # the chain is defined in
+        env = self.define('(define (a n) (b n))'
+                          '(define (b n) (c n))'
+                          '(define (c n) (+ n 1))'
+                          '(define (d n) (a n))')
+        self.assertPurity(env, a=True, b=True, c=True, d=True)
+        env = self.define('(define (a n) (b n))'
+                          '(define (d n) (a n))'
+                          '(define (b n) (c n))'
+                          '(define (c n) (+ n 1))')
+        self.assertPurity(env, a=True, b=True, c=True, d=True)
+
+    def test_impure(self):
+        env = self.define('(define (show x) (display x))'
+                          '(define (calls-show x) (show x))'
+                          '(define g 5)'
+                          '(define (uses-g) g)'
+                          '(define (set-g) (set! g 1))'
+                          '(define (call-arg f) (f 1))'
+                          '(define (loop-show n) (if (< n 1) (show n) (loop-show (- n 1))))')
+        self.assertPurity(env, show=False, calls_show=False, uses_g=False, set_g=False,
+                          call_arg=False, loop_show=False)
+
+    def test_builtins(self):
+        env = self.define('')
+        self.assertPurity(env, car=True, list=True, newline=True, display=False, python=False)
+        for name in ['vector-set!', 'hash-set!']:
+            self.assertFalse(env.glob_const[name].is_pure(), name)
+        # Not run at compile time
+        ins = comp.compile_expr(parse.parse_one(source.String(self.id(), '(python)')), env, optimizing=True)
+        self.assertTrue(any(isinstance(i, instr.Call) for i in ins))
+
+    def test_fold_pure_function(self):
+        env = self.define('(define (fact n) (if (< n 1) 1 (* n (fact (- n 1)))))')
+        ins = comp.compile_expr(parse.parse_one(source.String(self.id(), '(fact 5)')), env, optimizing=True)
+        self.assertEqual(len(ins), 1)
+        self.assertEqual(comp.get_load_literal(ins[0]).number, 120)
+
+        # Pure but never returns: given up on, left to runtime
+        env = self.define('(define (loop) (loop))')
+        ins = comp.compile_expr(parse.parse_one(source.String(self.id(), '(loop)')), env, optimizing=True)
+        self.assertIsInstance(ins[-1], instr.Call)
+
+class test_memo(unittest.TestCase):
+    def run_memo(self, src, size=100):
+        env = new_env()
+        env.memo = function.Memo(size)
+        output = eval_forms(env, comp.compile_iterator(iter(source.String(self.id(), src)), env))
+        return (env.memo, output)
+
+    def test_fib(self):
+        (memo, output) = self.run_memo('(define (fib n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))'
+                                       '(display (fib 60))')
+        self.assertEqual(output, '1548008755920')
+        self.assertEqual(memo.misses, 61)
+        self.assertEqual(memo.hits, 58)
+
+    def test_lru(self):
+        (memo, output) = self.run_memo('(define (sq x) (* x x))'
+                                       '(display (list (sq 1) (sq 2) (sq 1) (sq 3) (sq 2) (sq 1)))', size=2)
+        self.assertEqual(output, '(1 4 1 9 4 1)')
+        # (sq 2) is evicted by (sq 3), and (sq 1) by (sq 2)
+        self.assertEqual((memo.hits, memo.misses), (1, 5))
+        self.assertEqual(len(memo.results), 2)
+
+    def test_not_memoised(self):
+        (memo, output) = self.run_memo('(define (show x) (display x))'
+                                       '(define (pair x) (cons x x))'
+                                       '(define (loop n) (if (< n 1) 0 (loop (- n 1))))'
+                                       '(show 1) (show 1)'
+                                       '(display (eq? (pair 1) (pair 1)))'
+                                       '(display (pair 1.5))'
+                                       '(loop 1000)')
+        self.assertEqual(output, '11false(1.5 . 1.5)')
+        # Only the first call to loop is stored, tail calls are not
+        self.assertEqual([value.number for value in memo.results.values()], [0])
+
+class test_equal(unittest.TestCase):
+    def parse(self, text):
+        return parse.parse_one(source.String(self.id(), text))
+
+    def test_equal(self):
+        self.assertTrue(cons.equal(self.parse('(1 "a" (b . 2.0) \'c)'), self.parse('(1.0 "a" (b . 2) \'c)')))
+        self.assertFalse(cons.equal(self.parse('(1 "a")'), self.parse('(1 a)')))
+        self.assertFalse(cons.equal(self.parse('(1 2)'), self.parse('(1 2 3)')))
+        self.assertFalse(cons.equal(self.parse('(1 (2))'), self.parse('(1 2)')))
+
+    def test_long_and_deep(self):
+        n = 100000
+        long_a = cons.from_py(list(range(n)))
+        long_b = cons.from_py(list(range(n)))
+        self.assertTrue(cons.equal(long_a, long_b))
+        deep_a = self.parse('(' * n + ')' * n)
+        deep_b = self.parse('(' * n + ')' * n)
+        self.assertTrue(cons.equal(deep_a, deep_b))
+        self.assertEqual(cons.structural_hash(deep_a), cons.structural_hash(deep_b))
+        self.assertFalse(cons.equal(deep_a, self.parse('(' * n + '1' + ')' * n)))
+
+    def test_key(self):
+        d = {cons.Key(self.parse('(a (1 "s"))')): 1}
+        self.assertEqual(d.get(cons.Key(self.parse('(a (1.0 "s"))'))), 1)
+        self.assertIsNone(d.get(cons.Key(self.parse('(a (1 s))'))))
+        self.assertEqual(d.get(cons.Key(cons.Symbol('a'))), None)
+        self.assertEqual(cons.Key(cons.Symbol('a')), cons.Key(cons.Symbol('a')))
+
+    def test_cached_hash(self):
+        value = self.parse('(1 (2 x))')
+        h = cons.structural_hash(value)
+        self.assertEqual(value.hash_value, h)
+        self.assertEqual(value.cdr.car.hash_value, cons.structural_hash(self.parse('(2 x)')))
+        # Hashes depend on the process, and are not pickled
+        self.assertIsNone(pickle.loads(pickle.dumps(value)).hash_value)
+        self.assertTrue(cons.equal(pickle.loads(pickle.dumps(value)), value))
+
+@unittest.skipIf(cons.numpy is None, 'numpy is not installed')
+class test_array(eval_case):
+    def test_arithmetic(self):
+        self.assertDisplayEqual("""
+        (define a (list->array (list 1 2 3 4)))
+        (display (list (+ a 1) (* a a 0.5) (< a 3) (- 10 a 1)))""",
+                                '(#array(2 3 4 5) #array(0.5 2.0 4.5 8.0) #array(true true false false) #array(8 7 6 5))')
+
+    def test_reductions(self):
+        self.assertDisplayEqual("""
+        (define a (vector->array #(1 2 3 4)))
+        (display (list (array-sum a) (array-dot a a) (array-mean a) (array-ref a 1) (array-length a)))""",
+                                '(10 30 2.5 2 4)')
+        # Common names are left to programs, with or without numpy
+        self.assertDisplayEqual('(define (sum x) x) (display (sum 1))', '1')
+
+    def test_conversions(self):
+        self.assertDisplayEqual("""
+        (define a (array 1 2 3))
+        (display (list (array->list a) (array->vector a) (array->list (array-slice a 1 3))
+                       (equal? a (list->array '(1 2 3))) (array? a) (array? '(1))))""",
+                                '((1 2 3) #(1 2 3) (2 3) true true false)')
+        a = cons.Array(cons.numpy.arange(3))
+        self.assertIs(cons.to_py(a), a.array)
+        self.assertIs(cons.from_py(a.array).array, a.array)
+
+class test_finalize(unittest.TestCase):
+    def compile_function(self, src):
+        env = eval.Env(dbg)
+        basics.define_basics(env)
+        ins = comp.compile_module(iter(source.String(self.id(), src)), env, debuggable=True)
+        return ins[-1].loc
+
+    def test_function_code(self):
+        func = self.compile_function("""
+        (define (test x)
+          (define y (+ x 1))
+          (set! y (* y 2))
+          (lambda () y))
+        test""")
+        code = func.get_code()
+        self.assertIs(code, func.get_code())
+        # PushArgs only marks calls for the optimizer
+        pushes = len([i for i in func.ins if isinstance(i, instr.PushArgs)])
+        self.assertEqual(pushes, 2)
+        self.assertEqual(len(code), len(func.ins) - pushes)
+        self.assertEqual(len(code.tags), len(code))
+        for i in code:
+            self.assertNotIsInstance(i, instr.Load)
+            self.assertNotIsInstance(i, instr.Store)
+            self.assertNotIsInstance(i, instr.PushArgs)
+        self.assertTrue(any(isinstance(i, instr.MakeClosure) for i in code))
+        self.assertTrue(any(isinstance(i, instr.StoreLocal) for i in code))
+        self.assertFalse(func.frameless)
+
+    def test_frameless(self):
+        func = self.compile_function("""
+        (define (test x)
+          (define y (+ x 1))
+          (set! y (* y 2))
+          y)
+        test""")
+        code = func.get_code()
+        self.assertTrue(func.frameless)
+        self.assertTrue(any(isinstance(i, instr.LoadStack) for i in code))
+        self.assertTrue(any(isinstance(i, instr.StoreStack) for i in code))
+        self.assertFalse(any(isinstance(i, (instr.LoadLocal, instr.StoreLocal)) for i in code))
+        self.assertEqual(len(code.tags), len(code))
+
+        func = self.compile_function('(define (show x) (display x) x) show')
+        func.get_code()
+        self.assertFalse(func.frameless)
+
+class test_print(unittest.TestCase):
+    def test_sexpr(self):
+        value = parse.parse_one(source.String(self.id(), "(1 (2 (3)) '(a . b) \"s\" () (4 . (5 6)))"))
+        self.assertEqual(value.sexpr(), "(1 (2 (3)) '(a . b) \"s\" () (4 5 6))")
+        self.assertEqual(printer.sexpr(value, max_depth=1), "(1 ... '... \"s\" () ...)")
+        self.assertEqual(printer.sexpr(value, max_length=2), "(1 (2 (3)) ...)")
+
+    def test_vector(self):
+        value = parse.parse_one(source.String(self.id(), "#(1 #() (#(2 3)) 'a)"))
+        self.assertEqual(value.sexpr(), "#(1 #() (#(2 3)) 'a)")
+        self.assertEqual(printer.sexpr(value, max_depth=1), "#(1 ... ... 'a)")
+        self.assertEqual(printer.sexpr(value, max_length=1), "#(1 ...)")
+
+    def test_deep(self):
+        value = cons.NULL
+        for n in range(100000):
+            value = cons.Pair(value, cons.Number(n))
+        out = io.StringIO()
+        printer.write(out, value)
+        self.assertEqual(len(out.getvalue()), len(value.sexpr()))
+        self.assertTrue(out.getvalue().startswith('(' * 100000 + '() . 0) . 1) . 2)'))
+        self.assertTrue(out.getvalue().endswith(' . 99998) . 99999)'))
+
+class test_cache(unittest.TestCase):
+    def eval_file(self, *fns, **kw):
+        "Output of evaluating files in a new Env. kw are passed to compile_file"
+        env = new_env()
+        return ''.join([eval_forms(env, cache.compile_file(fn, env, **kw)) for fn in fns])
+
+    def test_alias(self):
+        # A value define of a function defined by an earlier form
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'alias.spr')
+            with open(fn, 'w') as f:
+                f.write("""
+                (define (f x) (+ x 1))
+                (define g f)
+                (display (list (g 3) (eq? f g)))""")
+            self.assertEqual(self.eval_file(fn, use_cache=False), '(4 true)')
+            for n in range(2):
+                self.assertEqual(self.eval_file(fn), '(4 true)')
+
+    def test_identity(self):
+        # Functions of earlier forms are the same objects on a warm run,
+        # and stored by name rather than copied into each form
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'identity.spr')
+            with open(fn, 'w') as f:
+                f.write("""
+                (define (f0 x) x)
+                (define (k) f0)
+                (define h (k))
+                (display (eq? h f0))""")
+                for n in range(1, 100):
+                    f.write('(define (f%d x) (f%d x))\n' % (n, n - 1))
+            sizes = []
+            for n in range(2):
+                self.assertEqual(self.eval_file(fn), 'true')
+                path = os.path.join(d, cache.CACHE_DIR, os.listdir(os.path.join(d, cache.CACHE_DIR))[0])
+                sizes.append(os.path.getsize(path))
+            self.assertEqual(sizes[0], sizes[1])
+            self.assertLess(sizes[0], 100 * 1000)
+
+    def test_other_file(self):
+        # Code compiled against functions of an earlier file is recompiled
+        # when they change, the optimizer inlines their results
+        with tempfile.TemporaryDirectory() as d:
+            a = os.path.join(d, 'a.spr')
+            b = os.path.join(d, 'b.spr')
+            with open(b, 'w') as f:
+                f.write('(display (f))')
+            for n in range(1, 3):
+                with open(a, 'w') as f:
+                    f.write('(define (f) %d)' % n)
+                for run in range(2):
+                    self.assertEqual(self.eval_file(a, b, optimizing=True), str(n))
+            # Stale entries are replaced, unchanged ones are reused
+            self.assertEqual(len(os.listdir(os.path.join(d, cache.CACHE_DIR))), 2)
+            self.assertEqual(self.eval_file(a, b, optimizing=True, use_cache=False), '2')
+
+    def test_compile_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'cached.spr')
+            with open(fn, 'w') as f:
+                f.write("""
+                (define (fib n)
+                  (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2)))))
+                (define (twice fn) (lambda (x) (fn (fn x))))
+                (display (list ((twice fib) 6) 'sym "str"))
+                (car 1)
+                (display "not reached")""")
+
+            def run():
+                env = new_env()
+                output = io.StringIO()
+                with self.assertRaises(error.Error) as cm:
+                    eval_forms(env, cache.compile_file(fn, env), output)
+                self.assertEqual(output.getvalue(), '(21 sym "str")')
+                self.assertEqual(debug.describe_tag(cm.exception.tag), fn + ':6:17')
+                self.assertEqual(debug.point_to_tag(cm.exception.tag).split('\n')[0].strip(), '(car 1)')
+
+            # Stopping early leaves no cache entry
+            run()
+            self.assertEqual(os.listdir(os.path.join(d, cache.CACHE_DIR)), [])
+
+            env = new_env()
+            self.assertEqual(len(list(cache.compile_file(fn, env))), 5)
+            self.assertEqual(len(os.listdir(os.path.join(d, cache.CACHE_DIR))), 1)
+            # Tags of cached code point at the source
+            run()
+
+            # Changed source invalidates the cache
+            with open(fn, 'a') as f:
+                f.write(' ')
+            env = new_env()
+            self.assertEqual(len(list(cache.compile_file(fn, env))), 5)
+            self.assertEqual(len(os.listdir(os.path.join(d, cache.CACHE_DIR))), 1)
+
 if __name__ == '__main__':
     unittest.main()